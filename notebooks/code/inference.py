@@ -1,39 +1,979 @@
+import fcntl
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import numpy as np
+import os
+import tempfile
+import threading
+import time
 import torch
-from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+from collections import OrderedDict
+from transformers import (AutoConfig, AutoModelForSeq2SeqLM, AutoTokenizer, GenerationConfig, LogitsProcessor,
+                          LogitsProcessorList)
+from transformers.modeling_outputs import BaseModelOutput
+import warnings
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# full prompts and predictions are logged only on request
+log_payloads = os.getenv("LOG_PAYLOADS", default="false").lower() == "true"
+metrics_namespace = os.getenv("METRICS_NAMESPACE", default="FlanT5/Inference")
+
+# gpu-int8 loads the model in 8-bit with bitsandbytes, cpu-int8 quantizes the linear layers dynamically, cpu keeps fp32
+inference_backend = os.getenv("INFERENCE_BACKEND", default="gpu-int8")
+# 0 keeps the torch defaults
+intra_op_threads = int(os.getenv("INTRA_OP_THREADS", default=0))
+inter_op_threads = int(os.getenv("INTER_OP_THREADS", default=0))
+
+# with the cpu backend, the workers of an instance memory-map a single read-only copy of the weights
+shared_weights = os.getenv("SHARED_WEIGHTS", default="false").lower() == "true"
+shared_weights_dir = os.getenv("SHARED_WEIGHTS_DIR", default="/tmp/shared-weights")
+
+# name of the model packaged at the root of model.tar.gz, smaller models of the cascade are packaged in tiers/<name>
+model_tier = os.getenv("MODEL_TIER", default="xxl")
+models = {}
+
+# run one token of generation at startup, so that the first request does not pay for the lazy initializations
+model_warmup = os.getenv("MODEL_WARMUP", default="true").lower() == "true"
+
+# time budget of a request when the request does not set deadline_ms, 0 means no deadline
+default_deadline_ms = float(os.getenv("DEFAULT_DEADLINE_MS", default=0))
+
+# admission control: requests generating at the same time and requests waiting for their turn, 0 disables it. Requests
+# only queue here when predict_fn is called from concurrent threads of the same process: the model server of the
+# inference toolkit sends one request at a time to each worker and queues the others itself
+max_in_flight = int(os.getenv("MAX_IN_FLIGHT", default=0))
+admission_queue_size = int(os.getenv("ADMISSION_QUEUE_SIZE", default=16))
+
+# waiting requests are admitted by priority class, lower values first
+priority_classes = {
+    "high": 0,
+    "normal": 1,
+    "low": 2
+}
+
+# long inputs are split in windows of tokens, generated in a single batch and combined by a reduce pass
+long_input_chunk_size = int(os.getenv("LONG_INPUT_CHUNK_SIZE", default=448))
+long_input_overlap = int(os.getenv("LONG_INPUT_OVERLAP", default=64))
+long_input_map_prompt = "Summarize the following text:\n\n{text}"
+long_input_reduce_prompt = "Summarize the following text:\n\n{text}"
+
+# max number of prompts passed to a single generate call
+batch_size = int(os.getenv("BATCH_SIZE", default=8))
+
+# cache of deterministic generations, 0 disables it
+response_cache_size = int(os.getenv("RESPONSE_CACHE_SIZE", default=1024))
+response_cache_dir = os.getenv("RESPONSE_CACHE_DIR", default=None)
+# max entries of the on-disk tier, the least recently used files are deleted beyond it
+response_cache_disk_size = int(os.getenv("RESPONSE_CACHE_DISK_SIZE", default=100000))
+
+# memory used by the cached encoder hidden states, 0 disables the cache
+encoder_cache_mb = float(os.getenv("ENCODER_CACHE_MB", default=256))
+
+class ResponseCache:
+    """
+    LRU cache of predictions, with an optional on-disk tier that survives worker restarts. The on-disk tier is shared by
+    the workers of the instance and bounded to max_disk_size files, evicted by last access time.
+    """
+    def __init__(self, max_size=1024, cache_dir=None, max_disk_size=100000):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.max_disk_size = max_disk_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "disk_evictions": 0
+        }
+        self.reported = {}
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # files written since the last scan of the directory are added to the count, so that the directory is
+            # only listed when it may exceed its size
+            self.disk_size = len(self.disk_files())
+
+    @staticmethod
+    def key(model_id, text, parameters):
+        return hashlib.sha256(json.dumps([model_id, text, parameters], sort_keys=True).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_deterministic(parameters):
+        # greedy and beam search always produce the same output, sampling does not
+        return not parameters.get("do_sample", False)
+
+    def disk_files(self):
+        return [name for name in os.listdir(self.cache_dir) if name.endswith(".json")]
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.metrics["hits"] += 1
+
+                return self.entries[key]
+
+        if self.cache_dir is not None:
+            path = os.path.join(self.cache_dir, key + ".json")
+
+            # the file can be evicted by another worker at any time, and a corrupt file is a miss
+            try:
+                with open(path, "r") as f:
+                    value = json.load(f)
+
+                # the access time of the file orders the evictions
+                os.utime(path)
+            except (FileNotFoundError, json.JSONDecodeError):
+                value = None
+
+            if value is not None:
+                self.store(key, value)
+
+                with self.lock:
+                    self.metrics["disk_hits"] += 1
+
+                return value
+
+        with self.lock:
+            self.metrics["misses"] += 1
+
+        return None
+
+    def put(self, key, value):
+        self.store(key, value)
+
+        if self.cache_dir is not None:
+            # write and rename, so that concurrent workers and threads never read a partial file
+            path = os.path.join(self.cache_dir, key + ".json")
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+
+            with os.fdopen(fd, "w") as f:
+                json.dump(value, f)
+
+            os.replace(tmp_path, path)
+
+            with self.lock:
+                self.disk_size += 1
+                evict = self.disk_size > self.max_disk_size
+
+            if evict:
+                self.evict_disk()
+
+    def evict_disk(self):
+        """
+        Delete the least recently used files beyond max_disk_size, down to 90% of it, so that the directory is not
+        listed again at every write.
+        """
+        files = []
+        for name in self.disk_files():
+            try:
+                files.append((os.stat(os.path.join(self.cache_dir, name)).st_mtime, name))
+            except FileNotFoundError:
+                continue
+
+        files.sort()
+        evicted = files[:max(0, len(files) - int(self.max_disk_size * 0.9))]
+
+        for _, name in evicted:
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                # evicted by another worker
+                pass
+
+        with self.lock:
+            self.disk_size = len(files) - len(evicted)
+            self.metrics["disk_evictions"] += len(evicted)
+
+    def store(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.metrics["evictions"] += 1
+
+response_cache = ResponseCache(response_cache_size, response_cache_dir, response_cache_disk_size) \
+    if response_cache_size > 0 else None
+
+class EncoderCache:
+    """
+    LRU cache of the encoder hidden states of tokenized prompts, bounded by the memory of the cached tensors. A prompt
+    generated again with different decoding parameters only runs the decoder.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.metrics = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0
+        }
+        self.reported = {}
+
+    @staticmethod
+    def key(model_id, input_ids):
+        return hashlib.sha256(json.dumps([model_id, input_ids]).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def tensor_bytes(tensor):
+        return tensor.element_size() * tensor.nelement()
+
+    def get(self, key):
+        with self.lock:
+            hidden_state = self.entries.get(key)
+
+            if hidden_state is None:
+                self.metrics["misses"] += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.metrics["hits"] += 1
+
+            return hidden_state
+
+    def put(self, key, hidden_state):
+        size = self.tensor_bytes(hidden_state)
+
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                return
+
+            self.entries[key] = hidden_state
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= self.tensor_bytes(evicted)
+                self.metrics["evictions"] += 1
+
+    def encode(self, model, encoded):
+        """
+        Return the encoder outputs of a right-padded batch, running the encoder only on the prompts missing from the
+        cache.
+        """
+        lengths = encoded.attention_mask.sum(dim=1).tolist()
+        keys = [
+            self.key(model.config._name_or_path, input_ids[:length].tolist())
+            for input_ids, length in zip(encoded.input_ids, lengths)
+        ]
+        hidden_states = [self.get(key) for key in keys]
+        missing = [index for index, hidden_state in enumerate(hidden_states) if hidden_state is None]
+
+        if len(missing) > 0:
+            outputs = model.get_encoder()(
+                input_ids=encoded.input_ids[missing],
+                attention_mask=encoded.attention_mask[missing])
+
+            for position, index in enumerate(missing):
+                # copy the rows, so that the cache does not keep alive the whole batch
+                hidden_states[index] = outputs.last_hidden_state[position, :lengths[index]].clone()
+                self.put(keys[index], hidden_states[index])
+
+        # padding positions are masked by the attention mask in the cross-attention
+        last_hidden_state = hidden_states[0].new_zeros(
+            (len(keys), encoded.input_ids.shape[1], hidden_states[0].shape[-1]))
+
+        for index, hidden_state in enumerate(hidden_states):
+            last_hidden_state[index, :lengths[index]] = hidden_state
+
+        emit_metrics([
+            ("EncoderCacheHits", len(keys) - len(missing), "Count"),
+            ("EncoderCacheMisses", len(missing), "Count"),
+            ("EncoderCacheEvictions", metric_deltas(self)["evictions"], "Count"),
+            ("EncoderCacheBytes", self.size, "Bytes")
+        ], {"Stage": "encoder_cache"})
+
+        return BaseModelOutput(last_hidden_state=last_hidden_state)
+
+encoder_cache = EncoderCache(int(encoder_cache_mb * 1024 * 1024)) if encoder_cache_mb > 0 else None
+
+def emit_metrics(metrics, dimensions=None):
+    """
+    Print the (name, value, unit) metrics as a CloudWatch embedded metric format record.
+    """
+    if dimensions is None:
+        dimensions = {}
+
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": metrics_namespace,
+                "Dimensions": [list(dimensions.keys())],
+                "Metrics": [{"Name": name, "Unit": unit} for name, _, unit in metrics]
+            }]
+        },
+        **dimensions
+    }
+
+    for name, value, _ in metrics:
+        record[name] = value
+
+    # records must be printed as plain json lines, without the logging prefix
+    print(json.dumps(record), flush=True)
+
+def metric_deltas(cache):
+    """
+    Return the counts of the cache metrics since the previous call, so that every record only carries its own events.
+    """
+    with cache.lock:
+        deltas = {name: value - cache.reported.get(name, 0) for name, value in cache.metrics.items()}
+        cache.reported = dict(cache.metrics)
+
+    return deltas
+
+def elapsed_ms(started):
+    return round((time.time() - started) * 1000, 3)
+
+def process_uptime_ms():
+    # time elapsed since the start of the worker process, only available on Linux
+    try:
+        with open("/proc/self/stat", "r") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+
+        return round((uptime - start_ticks / os.sysconf("SC_CLK_TCK")) * 1000, 3)
+    except Exception:
+        return None
+
+def memory_usage():
+    # resident memory of the worker, RssFile includes the pages shared with the other workers
+    usage = {}
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                if key in ["VmRSS", "RssAnon", "RssFile", "RssShmem"]:
+                    usage[key] = round(int(value.split()[0]) / 1024, 1)
+    except Exception:
+        pass
+
+    return usage
+
+def export_shared_weights(model_dir, weights_file, index_file):
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_dir, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+
+    index = {}
+    offset = 0
+    tmp_suffix = ".{}.tmp".format(os.getpid())
+
+    with open(weights_file + tmp_suffix, "wb") as f:
+        for name, tensor in model.state_dict().items():
+            array = tensor.detach().contiguous().numpy()
+
+            # keep every tensor aligned to 64 bytes
+            padding = -offset % 64
+            f.write(b"\0" * padding)
+            offset += padding
+
+            index[name] = {"dtype": str(array.dtype), "shape": list(array.shape), "offset": offset}
+
+            f.write(array.tobytes())
+            offset += array.nbytes
+
+    with open(index_file + tmp_suffix, "w") as f:
+        json.dump(index, f)
+
+    # the index is renamed last, so that its presence means the weights are complete
+    os.replace(weights_file + tmp_suffix, weights_file)
+    os.replace(index_file + tmp_suffix, index_file)
+
+def load_shared_model(model_dir, shared_dir):
+    """
+    Load the model with weights memory-mapped read-only from a file shared by all the workers of the instance.
+    The first worker writes the file, the others wait for it and map the same pages.
+    """
+    from accelerate import init_empty_weights
+
+    os.makedirs(shared_dir, exist_ok=True)
+    weights_file = os.path.join(shared_dir, "weights.bin")
+    index_file = os.path.join(shared_dir, "weights.json")
+
+    with open(os.path.join(shared_dir, "weights.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(index_file):
+                logger.info("Exporting shared weights to {}".format(shared_dir))
+                export_shared_weights(model_dir, weights_file, index_file)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    with open(index_file, "r") as f:
+        index = json.load(f)
+
+    with init_empty_weights():
+        model = AutoModelForSeq2SeqLM.from_config(AutoConfig.from_pretrained(model_dir))
+
+    weights = np.memmap(weights_file, dtype=np.uint8, mode="r")
+
+    with warnings.catch_warnings():
+        # the tensors are read-only, which is fine since the weights are never written during inference
+        warnings.simplefilter("ignore")
+
+        for name, entry in index.items():
+            dtype = np.dtype(entry["dtype"])
+            size = int(np.prod(entry["shape"])) * dtype.itemsize
+            array = weights[entry["offset"]:entry["offset"] + size].view(dtype).reshape(entry["shape"])
+            tensor = torch.from_numpy(array)
+
+            module_name, _, tensor_name = name.rpartition(".")
+            module = model.get_submodule(module_name)
+            if tensor_name in module._parameters:
+                module._parameters[tensor_name] = torch.nn.Parameter(tensor, requires_grad=False)
+            else:
+                module._buffers[tensor_name] = tensor
+
+    model.tie_weights()
+    model.eval()
+
+    if os.path.exists(os.path.join(model_dir, "generation_config.json")):
+        model.generation_config = GenerationConfig.from_pretrained(model_dir)
+
+    return model
+
+def load_model(model_dir, backend, shared_dir=shared_weights_dir):
+    # safetensors checkpoints are memory-mapped and the weights are materialized while they are placed
+    if backend == "gpu-int8":
+        return AutoModelForSeq2SeqLM.from_pretrained(
+            model_dir,
+            device_map="auto",
+            load_in_8bit=True,
+            low_cpu_mem_usage=True)
+
+    if backend in ["cpu", "cpu-int8"]:
+        if intra_op_threads > 0:
+            torch.set_num_threads(intra_op_threads)
+        if inter_op_threads > 0:
+            try:
+                torch.set_num_interop_threads(inter_op_threads)
+            except RuntimeError:
+                logger.warning("Inter-op threads can only be set before the first parallel work")
+
+        if shared_weights:
+            if backend == "cpu-int8":
+                raise ValueError("Shared weights are not supported with the cpu-int8 backend, "
+                                 "since each worker would quantize its own copy")
+
+            return load_shared_model(model_dir, shared_dir)
+
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_dir, torch_dtype=torch.float32, low_cpu_mem_usage=True)
+        model.eval()
+
+        if backend == "cpu-int8":
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        return model
+
+    raise ValueError("Unknown inference backend {}".format(backend))
+
+def warmup(model, tokenizer):
+    encoded = tokenizer("Hello", return_tensors="pt").to(model.device)
+
+    with torch.inference_mode():
+        model.generate(input_ids=encoded.input_ids, attention_mask=encoded.attention_mask, max_new_tokens=1)
+
 def model_fn(model_dir):
+    # SageMaker downloads and extracts model.tar.gz before starting the container, startup covers the time
+    # from the start of the worker process to model_fn
+    startup_ms = process_uptime_ms()
+
     # load model and processor from model_dir
-    model = AutoModelForSeq2SeqLM.from_pretrained(model_dir, device_map="auto", load_in_8bit=True)
+    started = time.time()
+    model = load_model(model_dir, inference_backend)
     tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    load_ms = elapsed_ms(started)
+
+    warmup_ms = 0.0
+    if model_warmup:
+        started = time.time()
+        warmup(model, tokenizer)
+        warmup_ms = elapsed_ms(started)
+
+    checkpoint_format = "safetensors" if any(f.endswith(".safetensors") for f in os.listdir(model_dir)) else "pytorch"
+
+    memory = memory_usage()
+
+    logger.info("Loaded {} model with backend {}{}: startup {} ms, load {} ms, warmup {} ms, "
+                "using {} intra-op and {} inter-op threads, memory (MB) {}".format(
+                    checkpoint_format, inference_backend, " and shared weights" if shared_weights else "",
+                    startup_ms, load_ms, warmup_ms, torch.get_num_threads(), torch.get_num_interop_threads(), memory))
+
+    metrics = [
+        ("ModelLoadLatency", load_ms, "Milliseconds"),
+        ("ModelWarmupLatency", warmup_ms, "Milliseconds")
+    ]
+    for key, value in memory.items():
+        metrics.append(("Worker" + key, value, "Megabytes"))
+    if startup_ms is not None:
+        metrics.append(("WorkerStartupLatency", startup_ms, "Milliseconds"))
+
+    emit_metrics(metrics, {"Backend": inference_backend})
+
+    models[model_tier] = (model, tokenizer)
+
+    # smaller models of the cascade
+    tiers_dir = os.path.join(model_dir, "tiers")
+    if os.path.isdir(tiers_dir):
+        for tier in sorted(os.listdir(tiers_dir)):
+            started = time.time()
+            tier_dir = os.path.join(tiers_dir, tier)
+            tier_model = load_model(tier_dir, inference_backend, os.path.join(shared_weights_dir, tier))
+            tier_tokenizer = AutoTokenizer.from_pretrained(tier_dir)
+
+            if model_warmup:
+                warmup(tier_model, tier_tokenizer)
+
+            models[tier] = (tier_model, tier_tokenizer)
+
+            logger.info("Loaded model tier {} in {} ms".format(tier, elapsed_ms(started)))
 
     return model, tokenizer
 
+class StopSequencesLogitsProcessor(LogitsProcessor):
+    """
+    Force the end of sequence token for every sequence of the batch that has generated one of the stop sequences,
+    so that generate stops as soon as all the sequences are either finished or stopped.
+    """
+    def __init__(self, tokenizer, stop_sequences):
+        self.tokenizer = tokenizer
+        self.stop_sequences = stop_sequences
+        # decoding the last tokens is enough for finding the longest stop sequence
+        self.window = max(len(tokenizer(stop, add_special_tokens=False).input_ids) for stop in stop_sequences) + 2
+
+    def __call__(self, input_ids, scores):
+        tails = self.tokenizer.batch_decode(input_ids[:, -self.window:], skip_special_tokens=True)
+
+        for row, text in enumerate(tails):
+            if any(stop in text for stop in self.stop_sequences):
+                scores[row, :] = -float("inf")
+                scores[row, self.tokenizer.eos_token_id] = 0
+
+        return scores
+
+def get_stop_sequences(parameters):
+    # stop_sequences is not a generate argument, the remaining parameters are
+    parameters = dict(parameters)
+    stop_sequences = parameters.pop("stop_sequences", None)
+
+    if isinstance(stop_sequences, str):
+        stop_sequences = [stop_sequences]
+
+    return [stop for stop in stop_sequences or [] if len(stop) > 0], parameters
+
+def trim_stop_sequences(text, stop_sequences):
+    positions = [text.find(stop) for stop in stop_sequences if stop in text]
+
+    return text[:min(positions)] if len(positions) > 0 else text
+
+def score_sequences(model, encoded, sequences, encoder_outputs=None):
+    """
+    Return the mean log-probability of the tokens of every generated sequence, used as the confidence of the output.
+    """
+    labels = sequences[:, 1:]
+    logits = model(
+        input_ids=encoded.input_ids,
+        attention_mask=encoded.attention_mask,
+        encoder_outputs=encoder_outputs,
+        decoder_input_ids=sequences[:, :-1]).logits
+
+    log_probs = torch.log_softmax(logits.float(), dim=-1).gather(-1, labels.unsqueeze(-1)).squeeze(-1)
+    mask = (labels != model.config.pad_token_id).float()
+
+    return ((log_probs * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)).tolist()
+
+@torch.inference_mode()
+def generate_batch(model, tokenizer, inputs, parameters=None, max_batch_size=batch_size, deadline=None,
+                   return_score=False):
+    """
+    Generate a prediction for every input, with the score of the output when return_score is set. When the deadline
+    (a timestamp) is reached, the decoding stops and the partial predictions are flagged as truncated.
+    """
+    if len(inputs) == 0:
+        return []
+
+    if parameters is None:
+        parameters = {}
+
+    num_return_sequences = parameters.get("num_return_sequences", 1)
+
+    stop_sequences, generate_parameters = get_stop_sequences(parameters)
+    if len(stop_sequences) > 0:
+        generate_parameters["logits_processor"] = LogitsProcessorList([
+            StopSequencesLogitsProcessor(tokenizer, stop_sequences)
+        ])
+
+    predictions = [None] * len(inputs)
+    keys = [None] * len(inputs)
+
+    if response_cache is not None and ResponseCache.is_deterministic(parameters):
+        for index, text in enumerate(inputs):
+            keys[index] = ResponseCache.key(model.config._name_or_path, text, parameters)
+            cached = response_cache.get(keys[index])
+
+            # entries written by previous versions only hold the generated text
+            if isinstance(cached, str):
+                cached = {"generated_text": cached}
+
+            if cached is not None and (not return_score or "score" in cached):
+                predictions[index] = dict(cached)
+
+        hits = len([prediction for prediction in predictions if prediction is not None])
+        deltas = metric_deltas(response_cache)
+
+        emit_metrics([
+            ("ResponseCacheHits", hits, "Count"),
+            ("ResponseCacheMisses", len(inputs) - hits, "Count"),
+            ("ResponseCacheDiskHits", deltas["disk_hits"], "Count"),
+            # the evictions caused by the writes of a call are reported with the lookups of the next call
+            ("ResponseCacheEvictions", deltas["evictions"], "Count"),
+            ("ResponseCacheDiskEvictions", deltas["disk_evictions"], "Count")
+        ], {"Stage": "response_cache"})
+
+    pending = [index for index, prediction in enumerate(predictions) if prediction is None]
+
+    if len(pending) == 0:
+        return predictions
+
+    # group prompts with similar token length, so that short prompts are not padded to the longest one
+    lengths = [len(input_ids) for input_ids in tokenizer([inputs[i] for i in pending]).input_ids]
+    order = [pending[i] for i in sorted(range(len(pending)), key=lambda i: lengths[i])]
+
+    for start in range(0, len(order), max_batch_size):
+        indexes = order[start:start + max_batch_size]
+
+        if deadline is not None:
+            remaining = deadline - time.time()
+
+            if remaining <= 0:
+                for index in indexes:
+                    predictions[index] = {"generated_text": "", "truncated": True}
+                continue
+
+            # generate stops the decoding of the whole batch after max_time seconds
+            generate_parameters["max_time"] = remaining
+
+        # preprocess
+        started = time.time()
+        encoded = tokenizer([inputs[i] for i in indexes], return_tensors="pt", padding=True).to(model.device)
+        tokenize_ms = elapsed_ms(started)
+
+        started = time.time()
+        encoder_outputs = None
+        if encoder_cache is not None:
+            encoder_outputs = encoder_cache.encode(model, encoded)
+            # generate expands the encoder outputs in place for beam search and multiple returned sequences
+            generate_parameters["encoder_outputs"] = BaseModelOutput(
+                last_hidden_state=encoder_outputs.last_hidden_state)
+
+        outputs = model.generate(
+            input_ids=encoded.input_ids,
+            attention_mask=encoded.attention_mask,
+            **generate_parameters)
+        generate_ms = elapsed_ms(started)
+
+        # postprocess the prediction, keeping the first returned sequence for each prompt
+        started = time.time()
+        decoded = tokenizer.batch_decode(outputs, skip_special_tokens=True)
+        decode_ms = elapsed_ms(started)
+
+        input_tokens = int(encoded.attention_mask.sum())
+        output_tokens = int((outputs != tokenizer.pad_token_id).sum())
+
+        emit_metrics([
+            ("TokenizeLatency", tokenize_ms, "Milliseconds"),
+            ("GenerateLatency", generate_ms, "Milliseconds"),
+            ("DecodeLatency", decode_ms, "Milliseconds"),
+            ("BatchSize", len(indexes), "Count"),
+            ("InputTokens", input_tokens, "Count"),
+            ("OutputTokens", output_tokens, "Count"),
+            ("OutputTokensPerSecond", round(output_tokens / max(generate_ms / 1000, 1e-6), 3), "Count/Second")
+        ], {"Stage": "generate_batch"})
+
+        deadline_reached = deadline is not None and time.time() >= deadline
+
+        if return_score:
+            scores = score_sequences(model, encoded, outputs[::num_return_sequences], encoder_outputs)
+
+        for position, index in enumerate(indexes):
+            output = outputs[position * num_return_sequences]
+            predictions[index] = {
+                "generated_text": trim_stop_sequences(decoded[position * num_return_sequences], stop_sequences)
+            }
+
+            if return_score:
+                predictions[index]["score"] = round(scores[position], 4)
+
+            # sequences without the end of sequence token were cut by the deadline
+            if deadline_reached and tokenizer.eos_token_id not in output[1:].tolist():
+                predictions[index]["truncated"] = True
+            elif keys[index] is not None:
+                response_cache.put(keys[index], dict(predictions[index]))
+
+    return predictions
+
+def split_windows(tokenizer, text, chunk_size, overlap):
+    """
+    Split the text in windows of chunk_size tokens, where consecutive windows share overlap tokens.
+    """
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True).offset_mapping
+
+    if len(offsets) <= chunk_size:
+        return [text]
+
+    windows = []
+    for start in range(0, len(offsets), chunk_size - overlap):
+        end = min(start + chunk_size, len(offsets))
+        windows.append(text[offsets[start][0]:offsets[end - 1][1]])
+
+        if end == len(offsets):
+            break
+
+    return windows
+
+def generate_long(model, tokenizer, inputs, parameters=None, options=None, max_batch_size=batch_size, deadline=None,
+                  return_score=False):
+    """
+    Map-reduce generation over inputs longer than the context of the model: the windows of all the inputs are
+    generated together with the map prompt, in batches of max_batch_size windows, then the outputs of every input are
+    joined and generated again with the reduce prompt, until they fit in a single window. With return_score, the
+    score of an input is the score of its last generation.
+    """
+    if not isinstance(options, dict):
+        options = {}
+
+    chunk_size = int(options.get("chunk_size", long_input_chunk_size))
+    overlap = int(options.get("overlap", long_input_overlap))
+    map_prompt = options.get("map_prompt", long_input_map_prompt)
+    reduce_prompt = options.get("reduce_prompt", long_input_reduce_prompt)
+
+    if not 0 <= overlap < chunk_size:
+        raise ValueError("overlap must be lower than chunk_size, got {} and {}".format(overlap, chunk_size))
+
+    texts = list(inputs)
+    predictions = [{"generated_text": ""} for _ in inputs]
+    pending = list(range(len(inputs)))
+    window_counts = [None] * len(inputs)
+    prompt = map_prompt
+
+    while len(pending) > 0:
+        windows = {index: split_windows(tokenizer, texts[index], chunk_size, overlap) for index in pending}
+
+        for index in pending:
+            if window_counts[index] is not None and len(windows[index]) >= window_counts[index]:
+                raise ValueError("The outputs of the windows are too long to be reduced, lower max_length or raise "
+                                 "chunk_size")
+
+            window_counts[index] = len(windows[index])
+
+        prompts = [prompt.format(text=window) for index in pending for window in windows[index]]
+
+        # only the inputs reduced to a single window get their final output at this level
+        level_return_score = return_score and any(len(windows[index]) == 1 for index in pending)
+
+        started = time.time()
+        outputs = generate_batch(model, tokenizer, prompts, parameters, max_batch_size, deadline,
+                                 level_return_score)
+
+        emit_metrics([
+            ("Windows", len(prompts), "Count"),
+            ("WindowsLatency", elapsed_ms(started), "Milliseconds")
+        ], {"Stage": "map" if prompt is map_prompt else "reduce"})
+
+        position = 0
+        next_pending = []
+        for index in pending:
+            window_outputs = outputs[position:position + len(windows[index])]
+            position += len(windows[index])
+
+            if any(output.get("truncated", False) for output in window_outputs):
+                predictions[index]["truncated"] = True
+
+            if len(window_outputs) == 1:
+                predictions[index]["generated_text"] = window_outputs[0]["generated_text"]
+
+                if return_score:
+                    predictions[index]["score"] = window_outputs[0]["score"]
+            else:
+                texts[index] = "\n".join(output["generated_text"] for output in window_outputs)
+                next_pending.append(index)
+
+        pending = next_pending
+        prompt = reduce_prompt
+
+    return predictions
+
+class Overloaded(Exception):
+    pass
+
+class AdmissionController:
+    """
+    Bound the requests generating at the same time and the requests waiting for a free slot. Waiting requests are
+    admitted by priority class, then by arrival, and rejected as soon as the queue is full or their deadline cannot be
+    met, so that a traffic spike does not make every request time out.
+    """
+    def __init__(self, max_in_flight, max_queue_size):
+        self.max_in_flight = max_in_flight
+        self.max_queue_size = max_queue_size
+        self.in_flight = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        # moving average of the time a request holds its slot, used for estimating the queue wait
+        self.service_time = None
+        self.condition = threading.Condition()
+        self.metrics = {
+            "admitted": 0,
+            "rejected": 0
+        }
+
+    def estimated_wait(self, ahead):
+        if self.service_time is None:
+            return 0
+
+        return self.service_time * (ahead // self.max_in_flight + 1)
+
+    def remove(self, entry):
+        self.waiting.remove(entry)
+        heapq.heapify(self.waiting)
+        self.condition.notify_all()
+
+    def wait_for_slot(self, priority, deadline):
+        """
+        Return None once a slot is taken, or the reason of the rejection.
+        """
+        if self.in_flight < self.max_in_flight and len(self.waiting) == 0:
+            self.in_flight += 1
+            return None
+
+        ahead = len([entry for entry in self.waiting if entry[0] <= priority])
+
+        if deadline is not None and time.time() + self.estimated_wait(ahead) > deadline:
+            return "the estimated queue wait exceeds the deadline"
+
+        if len(self.waiting) >= self.max_queue_size:
+            lowest = max(self.waiting)
+
+            if lowest[0] <= priority:
+                return "the queue is full"
+
+            # shed the last request of a lower priority class
+            lowest[2]["shed"] = True
+            self.remove(lowest)
+
+        entry = [priority, next(self.sequence), {"shed": False}]
+        heapq.heappush(self.waiting, entry)
+
+        while True:
+            if entry[2]["shed"]:
+                return "the request was shed for a higher priority request"
+
+            if self.waiting[0] is entry and self.in_flight < self.max_in_flight:
+                heapq.heappop(self.waiting)
+                self.in_flight += 1
+                # the next request may fit in another free slot
+                self.condition.notify_all()
+                return None
+
+            timeout = None if deadline is None else deadline - time.time()
+
+            if timeout is not None and timeout <= 0:
+                self.remove(entry)
+                return "the deadline expired in the queue"
+
+            self.condition.wait(timeout)
+
+    def acquire(self, priority="normal", deadline=None):
+        if priority not in priority_classes:
+            raise ValueError("Unknown priority {}, expected one of {}".format(priority, list(priority_classes)))
+
+        started = time.time()
+
+        with self.condition:
+            reason = self.wait_for_slot(priority_classes[priority], deadline)
+            queue_depth = len(self.waiting)
+            in_flight = self.in_flight
+            self.metrics["admitted" if reason is None else "rejected"] += 1
+
+        emit_metrics([
+            ("AdmissionWait", elapsed_ms(started), "Milliseconds"),
+            ("QueueDepth", queue_depth, "Count"),
+            ("InFlight", in_flight, "Count"),
+            ("Admitted", int(reason is None), "Count"),
+            ("Rejected", int(reason is not None), "Count")
+        ], {"Stage": "admission", "Priority": priority})
+
+        if reason is not None:
+            raise Overloaded("Overloaded: {}".format(reason))
+
+        return time.time()
+
+    def release(self, admitted):
+        with self.condition:
+            self.in_flight -= 1
+            service_time = time.time() - admitted
+            self.service_time = service_time if self.service_time is None else \
+                0.8 * self.service_time + 0.2 * service_time
+            self.condition.notify_all()
+
+admission = AdmissionController(max_in_flight, admission_queue_size) if max_in_flight > 0 else None
+
 def predict_fn(data, model_and_tokenizer):
+    started = time.time()
+
     # unpack model and tokenizer
     model, tokenizer = model_and_tokenizer
 
+    # requests can select one of the models of the cascade
+    tier = data.pop("model", None)
+    if tier is not None:
+        if tier not in models:
+            raise ValueError("Unknown model {}, expected one of {}".format(tier, list(models)))
+
+        model, tokenizer = models[tier]
+
     # process input
     inputs = data.pop("inputs", data)
     parameters = data.pop("parameters", None)
+    max_batch_size = int(data.pop("batch_size", batch_size))
+    deadline_ms = float(data.pop("deadline_ms", default_deadline_ms))
+    deadline = started + deadline_ms / 1000 if deadline_ms > 0 else None
+    priority = data.pop("priority", "normal")
+    long_input = data.pop("long_input", None)
+    return_score = data.pop("return_score", False)
 
-    logger.info("inputs: {}".format(inputs))
+    if log_payloads:
+        logger.info("inputs: {}".format(inputs))
 
-    # preprocess
-    input_ids = tokenizer(inputs, return_tensors="pt").input_ids
+    admitted = admission.acquire(priority, deadline) if admission is not None else None
 
-    # pass inputs with all kwargs in data
-    if parameters is not None:
-        outputs = model.generate(input_ids, **parameters)
-    else:
-        outputs = model.generate(input_ids)
+    if not isinstance(inputs, list):
+        inputs = [inputs]
 
-    # postprocess the prediction
-    prediction = tokenizer.decode(outputs[0], skip_special_tokens=True)
+    try:
+        if long_input is not None:
+            predictions = generate_long(model, tokenizer, inputs, parameters, long_input, max_batch_size, deadline,
+                                        return_score)
+        else:
+            predictions = generate_batch(model, tokenizer, inputs, parameters, max_batch_size, deadline, return_score)
+    finally:
+        if admission is not None:
+            admission.release(admitted)
 
-    logger.info("Prediction: {}".format(prediction))
+    if log_payloads:
+        logger.info("Prediction: {}".format(predictions))
 
-    return [{"generated_text": prediction}]
+    return predictions
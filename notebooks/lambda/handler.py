@@ -1,7 +1,18 @@
+import time
+
+# cold start timings, measured from the beginning of the module import
+import_started = time.time()
+
 import boto3
+from botocore.config import Config
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
 import logging
 import os
+import re
+import threading
 import traceback
 
 logger = logging.getLogger(__name__)
@@ -10,15 +21,286 @@ if len(logging.getLogger().handlers) > 0:
 else:
     logging.basicConfig(level=logging.INFO)
 
-comprehend_client = boto3.client("comprehend")
-sagemaker_runtime_client = boto3.client('sagemaker-runtime')
-translate_client = boto3.client("translate")
+# clients are created on first use and reused across warm invocations
+client_config = Config(
+    max_pool_connections=int(os.getenv("CLIENT_MAX_POOL_CONNECTIONS", default=50)),
+    tcp_keepalive=os.getenv("CLIENT_TCP_KEEPALIVE", default="true").lower() == "true",
+    retries={
+        "mode": os.getenv("CLIENT_RETRY_MODE", default="adaptive"),
+        "max_attempts": int(os.getenv("CLIENT_MAX_ATTEMPTS", default=5))
+    }
+)
+
+clients = {}
+clients_lock = threading.Lock()
+
+init_timings = {}
+cold_start = True
 
 endpoint_name = os.getenv("SAGEMAKER_ENDPOINT", default=None)
 
+# full payloads and translations are logged only on request
+log_payloads = os.getenv("LOG_PAYLOADS", default="false").lower() == "true"
+metrics_namespace = os.getenv("METRICS_NAMESPACE", default="FlanT5/Handler")
+
+# minimum confidence of the local detector for skipping the call to Amazon Comprehend
+local_detection_threshold = float(os.getenv("LOCAL_DETECTION_THRESHOLD", default=0.9))
+local_detection_min_words = int(os.getenv("LOCAL_DETECTION_MIN_WORDS", default=3))
+# share of the words explained by the detected language below which the confidence is lowered, since the text may be
+# written in a language without a profile
+local_detection_min_coverage = float(os.getenv("LOCAL_DETECTION_MIN_COVERAGE", default=0.4))
+
+# scripts written by a single language supported by Amazon Translate
+script_languages = {
+    "ja": re.compile(r"[\u3040-\u30ff]"),
+    "ko": re.compile(r"[\uac00-\ud7af\u1100-\u11ff]"),
+    "th": re.compile(r"[\u0e00-\u0e7f]"),
+    "el": re.compile(r"[\u0370-\u03ff]"),
+    "he": re.compile(r"[\u0590-\u05ff]")
+}
+
+# frequent function words that are not shared between the latin-script languages below
+language_words = {
+    "en": {"the", "and", "of", "to", "that", "it", "for", "you", "with", "are", "this", "be", "have", "not",
+           "what", "which", "from", "they", "will", "would", "there", "their", "been", "has", "how", "following", "text"},
+    "it": {"il", "di", "che", "è", "della", "per", "sono", "gli", "nel", "alla", "anche", "questo", "questa", "più",
+           "delle", "dei", "seguente", "testo", "suo", "essere", "degli", "sul", "perché"},
+    "es": {"el", "los", "las", "y", "pero", "más", "fue", "también", "siguiente", "muy", "hay", "cuando", "ellos",
+           "esto", "sus", "están", "entre", "desde", "porqué"},
+    "fr": {"les", "et", "est", "une", "dans", "pour", "pas", "sur", "avec", "ce", "cette", "sont", "au", "aux", "du",
+           "nous", "vous", "être", "été", "suivant", "ne", "leur", "elle"},
+    "de": {"der", "das", "und", "ist", "nicht", "ein", "eine", "den", "mit", "sich", "auf", "für", "dem", "von", "auch",
+           "wird", "sind", "wie", "bei", "nach", "aus", "oder", "folgenden", "zu", "im", "ich"},
+    "pt": {"não", "em", "dos", "das", "é", "seu", "foi", "ao", "são", "também", "isso", "você", "seguinte", "uma",
+           "com", "pelo", "pela"},
+    "nl": {"het", "een", "van", "dat", "niet", "op", "zijn", "voor", "er", "aan", "ook", "bij", "naar", "maar", "hij",
+           "wordt", "volgende", "deze"}
+}
+
+# other frequent words of the languages above, possibly shared between them, counted in the coverage of the text
+common_words = {
+    "en": {"a", "an", "is", "in", "on", "at", "by", "as", "or", "but", "i", "he", "she", "we", "me", "my", "his", "her",
+           "was", "were", "do", "did", "no", "so", "if", "up", "all", "can", "one", "about", "out", "who", "when",
+           "where", "why", "our", "your", "here", "good", "very", "than", "then", "them", "some", "more", "just"},
+    "it": {"a", "e", "la", "le", "lo", "i", "un", "una", "uno", "in", "da", "con", "non", "si", "ma", "come", "io",
+           "lui", "lei", "noi", "voi", "loro", "ho", "ha", "hanno", "mi", "ti", "ci", "se", "del", "al", "dal", "nella",
+           "qui", "bene", "molto", "tutto", "cosa", "quando", "dove", "era", "sei", "mio", "tuo"},
+    "es": {"a", "de", "la", "que", "en", "un", "una", "por", "con", "no", "se", "lo", "le", "es", "al", "del", "para",
+           "como", "su", "mi", "yo", "tu", "él", "ella", "me", "te", "era", "bien", "aquí", "todo", "qué", "donde",
+           "este", "esta", "ser", "tiene", "son"},
+    "fr": {"de", "la", "le", "un", "en", "il", "je", "tu", "on", "que", "qui", "se", "a", "à", "des", "par", "plus",
+           "mais", "ou", "son", "sa", "ses", "mon", "ma", "moi", "lui", "ici", "bien", "très", "tout", "fait", "bon",
+           "comme", "si", "y", "l", "d", "c", "j", "qu", "n", "s"},
+    "de": {"die", "es", "er", "sie", "wir", "ihr", "du", "in", "so", "an", "war", "hat", "haben", "mir", "mich", "dich",
+           "hier", "gut", "sehr", "aber", "noch", "nur", "wenn", "dass", "was", "wer", "man", "kein", "schon", "ja",
+           "nein", "dir", "mein", "sein"},
+    "pt": {"a", "o", "os", "as", "de", "do", "da", "que", "e", "um", "no", "na", "se", "por", "para", "mas", "eu",
+           "ele", "ela", "nós", "me", "te", "lhe", "mais", "como", "aqui", "bem", "muito", "tudo", "está", "ser", "tem"},
+    "nl": {"is", "de", "en", "in", "te", "ik", "je", "jij", "we", "wij", "ze", "zij", "mij", "me", "zo", "om", "met",
+           "als", "dan", "wat", "was", "hier", "goed", "heel", "al", "nog", "geen", "wel", "kan", "heb", "heeft", "die"}
+}
+
+word_pattern = re.compile(r"\w+", re.UNICODE)
+
+detection_tiers = {
+    "explicit": 0,
+    "local": 0,
+    "comprehend": 0
+}
+
+# Amazon Translate accepts up to 10,000 bytes of UTF-8 text per request
+translate_max_bytes = int(os.getenv("TRANSLATE_MAX_BYTES", default=9000))
+translate_max_workers = int(os.getenv("TRANSLATE_MAX_WORKERS", default=8))
+
+# concurrent items prepared and translated by batch events
+batch_max_workers = int(os.getenv("BATCH_MAX_WORKERS", default=8))
+# max prompts per endpoint request of a batch event, so that every request fits in the invocation timeout and payload
+batch_max_endpoint_items = int(os.getenv("BATCH_MAX_ENDPOINT_ITEMS", default=16))
+
+# Amazon Comprehend only needs the beginning of long texts for detecting the dominant language
+detect_max_chars = int(os.getenv("DETECT_MAX_CHARS", default=5000))
+
+# units used for splitting long texts, from the largest to the smallest
+split_patterns = [
+    re.compile(r".*?(?:\n\s*\n|$)", re.S),
+    re.compile(r".*?(?:[.!?\u3002\uff01\uff1f]+\s+|\n|$)", re.S),
+    re.compile(r"\S*\s*")
+]
+
+translation_cache_size = int(os.getenv("TRANSLATION_CACHE_SIZE", default=1024))
+translation_cache_ttl = int(os.getenv("TRANSLATION_CACHE_TTL", default=3600))
+translation_cache_table = os.getenv("TRANSLATION_CACHE_TABLE", default=None)
+
+# models of the endpoint, from the cheapest to the largest, requests start from the cheapest one allowed by the
+# routing rules and escalate to the next one when the output is not confident enough
+cascade_tiers = [tier for tier in os.getenv("CASCADE_TIERS", default="").split(",") if len(tier) > 0]
+# inputs with more words go straight to the largest model
+cascade_max_input_words = int(os.getenv("CASCADE_MAX_INPUT_WORDS", default=200))
+# outputs with a lower mean token log-probability are generated again by the next model
+cascade_min_score = float(os.getenv("CASCADE_MIN_SCORE", default=-1.0))
+
+# SageMaker real-time endpoints fail invocations lasting more than 60 seconds
+endpoint_timeout_ms = int(os.getenv("ENDPOINT_TIMEOUT_MS", default=60000))
+# time kept out of the endpoint budget for translating back the output and returning the response
+deadline_reserve_ms = int(os.getenv("DEADLINE_RESERVE_MS", default=500))
+
+def emit_metrics(metrics, dimensions=None):
+    """
+    Print the (name, value, unit) metrics as a CloudWatch embedded metric format record.
+    """
+    if dimensions is None:
+        dimensions = {}
+
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": metrics_namespace,
+                "Dimensions": [list(dimensions.keys())],
+                "Metrics": [{"Name": name, "Unit": unit} for name, _, unit in metrics]
+            }]
+        },
+        **dimensions
+    }
+
+    for name, value, _ in metrics:
+        record[name] = value
+
+    # records must be printed as plain json lines, without the logging prefix
+    print(json.dumps(record), flush=True)
+
+def elapsed_ms(started):
+    return round((time.time() - started) * 1000, 3)
+
+def get_client(service_name):
+    client = clients.get(service_name)
+
+    if client is None:
+        with clients_lock:
+            if service_name not in clients:
+                started = time.time()
+                clients[service_name] = boto3.client(service_name, config=client_config)
+                init_timings["client_" + service_name] = round((time.time() - started) * 1000, 1)
+
+            client = clients[service_name]
+
+    return client
+
+class DynamoDBCacheBackend:
+    """
+    Shared translation cache stored in a DynamoDB table with a string partition key named "key".
+    Enable TTL on the "expires_at" attribute to let DynamoDB delete the expired items.
+    """
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    def get(self, key):
+        response = get_client("dynamodb").get_item(
+            TableName=self.table_name,
+            Key={"key": {"S": key}},
+            ConsistentRead=False
+        )
+
+        item = response.get("Item")
+        if item is None or int(item["expires_at"]["N"]) < time.time():
+            return None
+
+        return item["translated_text"]["S"]
+
+    def put(self, key, value, ttl):
+        get_client("dynamodb").put_item(
+            TableName=self.table_name,
+            Item={
+                "key": {"S": key},
+                "translated_text": {"S": value},
+                "expires_at": {"N": str(int(time.time() + ttl))}
+            }
+        )
+
+class TranslationCache:
+    """
+    In-process LRU cache with TTL for translated strings, reused across warm invocations and shared by the threads
+    translating chunks and batch items. An optional backend with get(key) and put(key, value, ttl) methods is shared
+    across containers.
+    """
+    def __init__(self, max_size=1024, ttl=3600, backend=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def backend_key(key):
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def get(self, text, start_lan, end_lan):
+        key = (text, start_lan, end_lan)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+
+                if expires_at > time.time():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+
+                    return value
+
+                del self.entries[key]
+
+        # the backend is called without holding the lock, so that other threads are not blocked by the network
+        if self.backend is not None:
+            try:
+                value = self.backend.get(self.backend_key(key))
+            except Exception:
+                logger.warning("Translation cache backend error: {}".format(traceback.format_exc()))
+                value = None
+
+            if value is not None:
+                self.store(key, value)
+
+                with self.lock:
+                    self.hits += 1
+
+                return value
+
+        with self.lock:
+            self.misses += 1
+
+        return None
+
+    def put(self, text, start_lan, end_lan, value):
+        key = (text, start_lan, end_lan)
+
+        self.store(key, value)
+
+        if self.backend is not None:
+            try:
+                self.backend.put(self.backend_key(key), value, self.ttl)
+            except Exception:
+                logger.warning("Translation cache backend error: {}".format(traceback.format_exc()))
+
+    def store(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+translation_cache = TranslationCache(
+    translation_cache_size,
+    translation_cache_ttl,
+    DynamoDBCacheBackend(translation_cache_table) if translation_cache_table is not None else None
+)
+
 def detect_language(body):
     try:
-        results = comprehend_client.detect_dominant_language(Text=body)
+        results = get_client("comprehend").detect_dominant_language(Text=body[:detect_max_chars])
 
         max_result = max(results["Languages"], key=lambda x: x['Score'])
 
@@ -29,17 +311,145 @@ def detect_language(body):
 
         raise e
 
-def translate_string(row, start_lan="it", end_lan="en"):
-    try:
-        logger.info("Translating {} from {} to {}".format(row, start_lan, end_lan))
+def detect_language_local(body):
+    letters = [c for c in body if c.isalpha()]
+
+    if len(letters) == 0:
+        return None, 0.0
+
+    # languages with their own script, scored on the share of non-latin letters
+    for language, pattern in script_languages.items():
+        if pattern.search(body) is not None:
+            return language, len([c for c in letters if not c.isascii()]) / len(letters)
+
+    # latin-script languages, scored on their function words
+    words = word_pattern.findall(body.lower())
+    scores = sorted(
+        ((len([w for w in words if w in vocabulary]), language) for language, vocabulary in language_words.items()),
+        reverse=True
+    )
+
+    best_score, best_language = scores[0]
+    second_score = scores[1][0]
+
+    if best_score < local_detection_min_words:
+        return best_language, 0.0
+
+    # the margin over the runner-up only compares the known languages, the coverage tells whether the words are
+    # explained by the detected language at all
+    margin = best_score / (best_score + second_score)
+    vocabulary = language_words[best_language] | common_words[best_language]
+    coverage = len([w for w in words if w in vocabulary]) / len(words)
+
+    return best_language, margin * min(1.0, coverage / local_detection_min_coverage)
+
+def resolve_language(body, source_language=None):
+    """
+    Resolve the language of the payload and log the tier that produced it: the explicit source_language of the
+    event, the local detector, or Amazon Comprehend when the local confidence is below the threshold.
+    """
+    if source_language is not None:
+        language, tier = source_language, "explicit"
+    else:
+        language, confidence = detect_language_local(body)
+
+        if confidence >= local_detection_threshold:
+            tier = "local"
+        else:
+            language, tier = detect_language(body), "comprehend"
+
+    detection_tiers[tier] += 1
+
+    logger.info("Detected {} language with tier {}, tier counts: {}".format(language, tier, detection_tiers))
+
+    emit_metrics([("LanguageDetections", 1, "Count")], {"DetectionTier": tier})
 
-        response = translate_client.translate_text(
-            Text=row,
+    return language
+
+def split_units(text, max_bytes, level=0):
+    if len(text.encode("utf-8")) <= max_bytes:
+        return [text]
+
+    if level == len(split_patterns):
+        # no boundary left, cut the text on characters
+        units = []
+        current = ""
+        for c in text:
+            if len((current + c).encode("utf-8")) > max_bytes:
+                units.append(current)
+                current = ""
+            current += c
+
+        return units + [current]
+
+    units = []
+    for unit in split_patterns[level].findall(text):
+        if len(unit) > 0:
+            units.extend(split_units(unit, max_bytes, level + 1))
+
+    return units
+
+def split_text(text, max_bytes=translate_max_bytes):
+    """
+    Split the text at paragraph, sentence and word boundaries into chunks smaller than max_bytes.
+    Joining the chunks gives back the original text.
+    """
+    chunks = []
+    current = ""
+    for unit in split_units(text, max_bytes):
+        if len(current) > 0 and len((current + unit).encode("utf-8")) > max_bytes:
+            chunks.append(current)
+            current = ""
+        current += unit
+
+    if len(current) > 0:
+        chunks.append(current)
+
+    return chunks
+
+def translate_chunk(row, start_lan, end_lan):
+    # keep the whitespace around the chunk, which is not returned by Amazon Translate
+    text = row.strip()
+    if len(text) == 0:
+        return row
+
+    leading = row[:len(row) - len(row.lstrip())]
+    trailing = row[len(row.rstrip()):]
+
+    translated = translation_cache.get(text, start_lan, end_lan)
+
+    if translated is None:
+        if log_payloads:
+            logger.info("Translating {} from {} to {}".format(text, start_lan, end_lan))
+
+        # throttled requests are retried by the client with exponential backoff
+        response = get_client("translate").translate_text(
+            Text=text,
             SourceLanguageCode=start_lan,
             TargetLanguageCode=end_lan
         )
 
-        return response["TranslatedText"]
+        translated = response["TranslatedText"]
+        translation_cache.put(text, start_lan, end_lan, translated)
+
+    return leading + translated + trailing
+
+def translate_string(row, start_lan="it", end_lan="en"):
+    try:
+        chunks = split_text(row)
+
+        if len(chunks) <= 1:
+            translated = translate_chunk(row, start_lan, end_lan)
+        else:
+            logger.info("Translating {} chunks from {} to {}".format(len(chunks), start_lan, end_lan))
+
+            # chunks are translated concurrently and joined back in order
+            with ThreadPoolExecutor(max_workers=min(translate_max_workers, len(chunks))) as executor:
+                translated = "".join(executor.map(lambda chunk: translate_chunk(chunk, start_lan, end_lan), chunks))
+
+        logger.info("Translation cache hits: {}, misses: {}".format(translation_cache.hits, translation_cache.misses))
+
+        return translated
 
     except Exception as e:
         stacktrace = traceback.format_exc()
@@ -47,52 +457,361 @@ def translate_string(row, start_lan="it", end_lan="en"):
 
         raise e
 
-def lambda_handler(event, context):
-    try:
-        payload = event["payload"]
-        parameters = event["parameters"]
+def translate_parameters(parameters, start_lan):
+    # stop sequences are written in the language of the payload, while the model generates english text
+    if parameters is None or start_lan == "en" or "stop_sequences" not in parameters:
+        return parameters
 
-        if len(payload) < 10000:
-            start_lan = detect_language(payload)
+    stop_sequences = parameters["stop_sequences"]
+    if isinstance(stop_sequences, str):
+        stop_sequences = [stop_sequences]
 
-            if start_lan != "en":
-                payload = translate_string(payload, start_lan, "en")
+    return {
+        **parameters,
+        "stop_sequences": [
+            translate_string(stop, start_lan, "en") if any(c.isalpha() for c in stop) else stop
+            for stop in stop_sequences
+        ]
+    }
 
-                logger.info("Translated sentence: {}".format(payload))
-            else:
-                logger.info("Detected en language")
+class DeadlineExceeded(Exception):
+    pass
+
+def is_overloaded(e):
+    """
+    Return whether the endpoint rejected the request because of its admission control or of throttling.
+    """
+    error_code = getattr(e, "response", {}).get("Error", {}).get("Code")
+
+    return error_code == "ThrottlingException" or "Overloaded" in str(e)
+
+def request_deadline(event, context, started):
+    """
+    Return the timestamp by which the response is due, from the "deadline_ms" of the event and the remaining time of
+    the lambda invocation, or None when neither is known.
+    """
+    budgets = []
+
+    if event.get("deadline_ms") is not None:
+        budgets.append(float(event["deadline_ms"]))
+
+    if hasattr(context, "get_remaining_time_in_millis"):
+        budgets.append(context.get_remaining_time_in_millis())
+
+    if len(budgets) == 0:
+        return None
+
+    return started + min(budgets) / 1000
+
+def endpoint_deadline_ms(deadline):
+    """
+    Return the generation budget sent to the endpoint: the time left before the deadline, without the time already
+    spent by the handler and the reserve for translating back the output.
+    """
+    budget = endpoint_timeout_ms
+
+    if deadline is not None:
+        budget = min(budget, (deadline - time.time()) * 1000)
+
+    budget = int(budget - deadline_reserve_ms)
+
+    if budget <= 0:
+        raise DeadlineExceeded("No time left for generating the response")
+
+    return budget
+
+def invoke_endpoint(body):
+    response = get_client("sagemaker-runtime").invoke_endpoint(
+        EndpointName=endpoint_name,
+        ContentType='application/json',
+        Body=json.dumps(body))
+
+    return json.loads(response['Body'].read().decode())
+
+def first_tier(event, payload):
+    """
+    Return the index of the cascade tier a request starts from: the tier named by the "tier" hint of the event, the
+    largest tier for long inputs, the cheapest tier otherwise.
+    """
+    if event.get("tier") is not None:
+        if event["tier"] not in cascade_tiers:
+            raise ValueError("Unknown tier {}, expected one of {}".format(event["tier"], cascade_tiers))
+
+        return cascade_tiers.index(event["tier"])
+
+    if len(word_pattern.findall(payload)) > cascade_max_input_words:
+        return len(cascade_tiers) - 1
+
+    return 0
 
-            response = sagemaker_runtime_client.invoke_endpoint(
+def invoke_cascade(event, body, deadline):
+    """
+    Generate with the first tier allowed by the routing rules, escalating to the next tier while the score of the
+    output is lower than the minimum score. Requests with a tier hint are never escalated.
+    """
+    if len(cascade_tiers) == 0:
+        return invoke_endpoint({**body, "deadline_ms": endpoint_deadline_ms(deadline)})
+
+    tier = first_tier(event, body["inputs"])
+    deadline_ms = endpoint_deadline_ms(deadline)
+
+    while True:
+        can_escalate = event.get("tier") is None and tier < len(cascade_tiers) - 1
+
+        started = time.time()
+        results = invoke_endpoint({
+            **body,
+            "model": cascade_tiers[tier],
+            "return_score": can_escalate,
+            "deadline_ms": deadline_ms
+        })
+
+        # truncated outputs are not escalated, since the next tier would have even less time
+        escalate = can_escalate and not results[0].get("truncated", False) and \
+            results[0].get("score", 0) < cascade_min_score
+
+        if escalate:
+            try:
+                deadline_ms = endpoint_deadline_ms(deadline)
+            except DeadlineExceeded:
+                # the output of the current tier is better than no output
+                logger.info("No time left for escalating from tier {}".format(cascade_tiers[tier]))
+                escalate = False
+
+        emit_metrics([
+            ("TierRequests", 1, "Count"),
+            ("TierLatency", elapsed_ms(started), "Milliseconds"),
+            ("Escalations", int(escalate), "Count")
+        ], {"Tier": cascade_tiers[tier]})
+
+        if not escalate:
+            results[0]["tier"] = cascade_tiers[tier]
+            return results
+
+        logger.info("Escalating from tier {} with score {}".format(cascade_tiers[tier], results[0]["score"]))
+        tier += 1
+
+def prepare_item(item, parameters):
+    start_lan = resolve_language(item["payload"], item.get("source_language"))
+
+    if start_lan != "en":
+        return start_lan, translate_string(item["payload"], start_lan, "en"), translate_parameters(parameters, start_lan)
+
+    return start_lan, item["payload"], parameters
+
+def batch_handler(event, context, deadline=None):
+    """
+    Handle an event carrying many payloads, either as "payloads" sharing the event "parameters" or as "items" with
+    their own "payload", "parameters" and "source_language". Every item gets its own status in the results.
+    """
+    if "items" in event:
+        items = event["items"]
+    else:
+        items = [{"payload": payload} for payload in event["payloads"]]
+
+    results = [None] * len(items)
+    prepared = [None] * len(items)
+
+    def prepare(index):
+        try:
+            prepared[index] = prepare_item(items[index], items[index].get("parameters", event.get("parameters")))
+        except Exception as e:
+            logger.error("{}".format(traceback.format_exc()))
+            results[index] = {"statusCode": 500, "error": str(e)}
+
+    endpoint_requests = []
+
+    def generate(indexes):
+        parameters = prepared[indexes[0]][2]
+        endpoint_requests.append(len(indexes))
+
+        try:
+            response = get_client("sagemaker-runtime").invoke_endpoint(
                 EndpointName=endpoint_name,
                 ContentType='application/json',
                 Body=json.dumps({
-                    "inputs": payload,
-                    "parameters": parameters
+                    "inputs": [prepared[index][1] for index in indexes],
+                    "parameters": parameters,
+                    "deadline_ms": endpoint_deadline_ms(deadline),
+                    "priority": event.get("priority", "normal")
                 }))
 
-            results = json.loads(response['Body'].read().decode())
+            predictions = json.loads(response['Body'].read().decode())
+
+            for index, prediction in zip(indexes, predictions):
+                results[index] = {"statusCode": 200, **prediction}
+        except DeadlineExceeded as e:
+            for index in indexes:
+                results[index] = {"statusCode": 504, "error": str(e)}
+        except Exception as e:
+            if len(indexes) > 1 and not is_overloaded(e):
+                # retry the two halves, so that only the failing prompts get an error
+                logger.warning("Endpoint request of {} items failed, splitting it: {}".format(len(indexes), e))
+                generate(indexes[:len(indexes) // 2])
+                generate(indexes[len(indexes) // 2:])
+                return
 
+            logger.error("{}".format(traceback.format_exc()))
+            for index in indexes:
+                results[index] = {"statusCode": 429 if is_overloaded(e) else 500, "error": str(e)}
+
+    def translate_back(index):
+        start_lan = prepared[index][0]
+
+        try:
             if start_lan != "en":
-                results[0]["generated_text"] = translate_string(results[0]["generated_text"], "en", start_lan)
-            else:
-                logger.info("Detected en language")
+                results[index]["generated_text"] = translate_string(results[index]["generated_text"], "en", start_lan)
+        except Exception as e:
+            logger.error("{}".format(traceback.format_exc()))
+            results[index] = {"statusCode": 500, "error": str(e)}
 
-            return {
-                'statusCode': 200,
-                'body': json.dumps(results)
-            }
+    request_started = time.time()
+
+    with ThreadPoolExecutor(max_workers=batch_max_workers) as executor:
+        started = time.time()
+        list(executor.map(prepare, range(len(items))))
+        prepare_ms = elapsed_ms(started)
+
+        # prompts sharing the same generation parameters go to the endpoint together, in requests of at most
+        # batch_max_endpoint_items prompts
+        groups = OrderedDict()
+        for index, item in enumerate(items):
+            if results[index] is None:
+                key = json.dumps(prepared[index][2], sort_keys=True)
+                groups.setdefault(key, []).append(index)
+
+        chunks = [
+            group[start:start + batch_max_endpoint_items]
+            for group in groups.values()
+            for start in range(0, len(group), batch_max_endpoint_items)
+        ]
+
+        logger.info("Batch of {} items, {} endpoint requests".format(len(items), len(chunks)))
+
+        started = time.time()
+        list(executor.map(generate, chunks))
+        invoke_ms = elapsed_ms(started)
+
+        started = time.time()
+        list(executor.map(translate_back, [index for index, result in enumerate(results) if result["statusCode"] == 200]))
+        translate_output_ms = elapsed_ms(started)
+
+    emit_metrics([
+        ("DetectAndTranslateInputLatency", prepare_ms, "Milliseconds"),
+        ("InvokeEndpointLatency", invoke_ms, "Milliseconds"),
+        ("TranslateOutputLatency", translate_output_ms, "Milliseconds"),
+        ("TotalLatency", elapsed_ms(request_started), "Milliseconds"),
+        ("Items", len(items), "Count"),
+        ("EndpointRequests", len(endpoint_requests), "Count"),
+        ("FailedItems", len([result for result in results if result["statusCode"] != 200]), "Count"),
+        ("TruncatedItems", len([result for result in results if result.get("truncated", False)]), "Count"),
+        ("OverloadedItems", len([result for result in results if result["statusCode"] == 429]), "Count")
+    ], {"Handler": "batch"})
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(results)
+    }
+
+def handle_event(event, context):
+    deadline = request_deadline(event, context, time.time())
+
+    try:
+        if "items" in event or "payloads" in event:
+            return batch_handler(event, context, deadline)
+
+        request_started = time.time()
+
+        payload = event["payload"]
+        parameters = event["parameters"]
+
+        started = time.time()
+        start_lan = resolve_language(payload, event.get("source_language"))
+        metrics = [("DetectLatency", elapsed_ms(started), "Milliseconds")]
+
+        if start_lan != "en":
+            started = time.time()
+            payload = translate_string(payload, start_lan, "en")
+            parameters = translate_parameters(parameters, start_lan)
+            metrics.append(("TranslateInputLatency", elapsed_ms(started), "Milliseconds"))
+
+            if log_payloads:
+                logger.info("Translated sentence: {}".format(payload))
         else:
-            return {
-                'statusCode': 500,
-                'body': json.dumps({
-                    "generated_text": "Text cannot be longer than 10.000 characters."
-                })
-            }
+            logger.info("Detected en language")
+
+        body = {
+            "inputs": payload,
+            "parameters": parameters,
+            "priority": event.get("priority", "normal")
+        }
+
+        # documents longer than the context of the model are generated with map-reduce by the endpoint
+        if event.get("long_input") is not None:
+            body["long_input"] = event["long_input"]
+
+        started = time.time()
+        results = invoke_cascade(event, body, deadline)
+        metrics.append(("InvokeEndpointLatency", elapsed_ms(started), "Milliseconds"))
+
+        truncated = results[0].get("truncated", False)
+        if truncated:
+            logger.info("Generation truncated by the deadline")
+
+        if start_lan != "en":
+            started = time.time()
+            results[0]["generated_text"] = translate_string(results[0]["generated_text"], "en", start_lan)
+            metrics.append(("TranslateOutputLatency", elapsed_ms(started), "Milliseconds"))
+        else:
+            logger.info("Detected en language")
+
+        metrics.append(("TotalLatency", elapsed_ms(request_started), "Milliseconds"))
+        metrics.append(("TruncatedResponses", int(truncated), "Count"))
+        emit_metrics(metrics, {"Handler": "single"})
+
+        return {
+            'statusCode': 200,
+            'body': json.dumps(results)
+        }
+    except DeadlineExceeded as e:
+        logger.error("{}".format(e))
+
+        return {
+            'statusCode': 504,
+            'body': json.dumps({"error": str(e)})
+        }
     except Exception as e:
         stacktrace = traceback.format_exc()
         logger.error("{}".format(stacktrace))
 
+        if is_overloaded(e):
+            # the caller can retry later or elsewhere, instead of waiting for a timeout
+            emit_metrics([("OverloadedRequests", 1, "Count")])
+
+            return {
+                'statusCode': 429,
+                'body': json.dumps({"error": str(e)})
+            }
+
         return {
             'statusCode': 500,
-            'body': json.dumps(e)
+            'body': json.dumps({"error": str(e)})
         }
+
+def lambda_handler(event, context):
+    global cold_start
+
+    started = time.time()
+
+    response = handle_event(event, context)
+
+    if cold_start:
+        cold_start = False
+        init_timings["first_invocation"] = round((time.time() - started) * 1000, 1)
+
+        logger.info("Cold start timings (ms): {}".format(json.dumps(init_timings)))
+
+    return response
+
+# module import time, including boto3 and the module level definitions above
+init_timings["import"] = round((time.time() - import_started) * 1000, 1)
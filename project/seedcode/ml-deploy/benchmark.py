@@ -0,0 +1,408 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import importlib.util
+import io
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import resource
+import sys
+from tempfile import TemporaryDirectory
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
+
+logger = logging.getLogger(__name__)
+
+english_words = ["the", "party", "taxi", "city", "doctor", "hospital", "stayed", "with", "her", "for", "days", "and",
+                 "summarize", "following", "text", "night", "took", "attend", "while", "was", "rushed", "to", "of"]
+italian_words = ["il", "testo", "seguente", "della", "festa", "città", "sono", "anche", "per", "che", "di", "notte",
+                 "ospedale", "medico", "questo", "giorni", "nel", "alla", "più", "dei", "riassumete"]
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+def build_tiny_checkpoint(model_dir, vocab_size=512):
+    """
+    Save a randomly initialized T5 model with a word level tokenizer, small enough for running on CPU.
+    """
+    from tokenizers import Tokenizer, models, pre_tokenizers, processors
+    from transformers import PreTrainedTokenizerFast, T5Config, T5ForConditionalGeneration
+
+    words = english_words + italian_words
+    vocab = {"<pad>": 0, "</s>": 1, "<unk>": 2}
+    for word in words + ["w{}".format(i) for i in range(vocab_size - len(words) - len(vocab))]:
+        vocab.setdefault(word, len(vocab))
+
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.post_processor = processors.TemplateProcessing(single="$A </s>", special_tokens=[("</s>", 1)])
+
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        pad_token="<pad>",
+        eos_token="</s>",
+        unk_token="<unk>"
+    ).save_pretrained(model_dir)
+
+    config = T5Config(
+        vocab_size=len(vocab),
+        d_model=64,
+        d_ff=128,
+        d_kv=16,
+        num_layers=2,
+        num_heads=4,
+        pad_token_id=0,
+        eos_token_id=1,
+        decoder_start_token_id=0
+    )
+    T5ForConditionalGeneration(config).save_pretrained(model_dir)
+
+def random_prompt(words, length):
+    return " ".join(random.choice(words) for _ in range(length))
+
+def resident_memory_mb():
+    # current resident memory, only available on Linux
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+
+    return None
+
+class MemorySampler:
+    """
+    Sample the resident memory in a background thread while a scenario runs, so that every scenario reports its own
+    peak instead of the peak of the whole process, which only grows from one scenario to the next.
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        memory = resident_memory_mb()
+        if memory is not None:
+            self.peak = memory if self.peak is None else max(self.peak, memory)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self.thread.start()
+
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        self.sample()
+
+    def peak_memory_mb(self):
+        if self.peak is not None:
+            return self.peak
+
+        # without /proc, fall back to the peak of the process, ru_maxrss is reported in kilobytes on Linux
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def percentile(values, q):
+    # nearest rank percentile
+    values = sorted(values)
+
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+def is_max_rank(q, samples):
+    # with up to 100 samples the p99 is the slowest request, with up to 20 the p95 as well
+    return math.ceil(q / 100 * samples) >= samples
+
+def run_scenario(name, requests, call, concurrency=1, items_per_request=1):
+    """
+    Run call(request) for every request on a pool of concurrency threads and summarize the latencies.
+    """
+    latencies = []
+
+    def timed(request):
+        started = time.time()
+        call(request)
+        latencies.append((time.time() - started) * 1000)
+
+    started = time.time()
+    # metrics records printed by the inference and handler code are not part of the report
+    with contextlib.redirect_stdout(io.StringIO()), MemorySampler() as memory:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed, requests))
+    duration = time.time() - started
+
+    result = {
+        "name": name,
+        "requests": len(requests),
+        "concurrency": concurrency,
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "throughput_rps": round(len(requests) / duration, 3),
+        "throughput_items_per_second": round(len(requests) * items_per_request / duration, 3),
+        "peak_memory_mb": memory.peak_memory_mb()
+    }
+
+    logger.info("{}: p50 {} ms, p95 {} ms, p99 {} ms{}, {} req/s, peak memory {} MB".format(
+        name, result["p50_ms"], result["p95_ms"], result["p99_ms"],
+        " (max of {} requests)".format(len(requests)) if is_max_rank(99, len(requests)) else "",
+        result["throughput_rps"], result["peak_memory_mb"]))
+
+    return result
+
+def load_inference(model_dir, backend):
+    # the backend is read by the inference module when it is imported
+    os.environ["INFERENCE_BACKEND"] = backend
+
+    inference = load_module("inference", os.path.join(BASE_DIR, "code", "inference.py"))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        model_and_tokenizer = inference.model_fn(model_dir)
+
+    return inference, model_and_tokenizer
+
+def benchmark_inference(args, model_dir):
+    inference, model_and_tokenizer = load_inference(model_dir, args.backend)
+
+    results = []
+    for batch_size, input_length, max_length, num_beams in itertools.product(
+            args.batch_sizes, args.input_lengths, args.max_lengths, args.num_beams):
+        parameters = {"max_length": max_length, "num_beams": num_beams}
+        requests = [
+            [random_prompt(english_words, input_length) for _ in range(batch_size)]
+            for _ in range(args.iterations)
+        ]
+
+        def call(prompts):
+            inference.predict_fn({"inputs": prompts, "parameters": dict(parameters)}, model_and_tokenizer)
+
+        # the first request pays for one-off allocations
+        with contextlib.redirect_stdout(io.StringIO()):
+            call(requests[0])
+
+        name = "inference/batch={}/input={}/max_length={}/beams={}".format(batch_size, input_length, max_length, num_beams)
+        results.append(run_scenario(name, requests, call, items_per_request=batch_size))
+
+    return results
+
+class StubComprehend:
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000
+
+    def detect_dominant_language(self, Text):
+        time.sleep(self.latency)
+
+        language = "it" if any(word in italian_words for word in Text.split()) else "en"
+
+        return {"Languages": [{"LanguageCode": language, "Score": 0.99}]}
+
+class StubTranslate:
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000
+
+    def translate_text(self, Text, SourceLanguageCode, TargetLanguageCode):
+        time.sleep(self.latency)
+
+        return {"TranslatedText": Text}
+
+class StubSageMakerRuntime:
+    def __init__(self, latency_ms, per_item_latency_ms=0):
+        self.latency = latency_ms / 1000
+        self.per_item_latency = per_item_latency_ms / 1000
+
+    def invoke_endpoint(self, EndpointName, ContentType, Body):
+        inputs = json.loads(Body)["inputs"]
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+
+        time.sleep(self.latency + self.per_item_latency * len(inputs))
+
+        return {"Body": io.BytesIO(json.dumps([{"generated_text": text} for text in inputs]).encode("utf-8"))}
+
+def load_handler(args):
+    handler = load_module("handler", os.path.join(BASE_DIR, "lambda", "handler.py"))
+
+    handler.clients.update({
+        "comprehend": StubComprehend(args.comprehend_latency_ms),
+        "translate": StubTranslate(args.translate_latency_ms),
+        "sagemaker-runtime": StubSageMakerRuntime(args.endpoint_latency_ms, args.endpoint_item_latency_ms)
+    })
+
+    if not args.translation_cache:
+        handler.translation_cache.max_size = 0
+
+    return handler
+
+def benchmark_handler(args):
+    handler = load_handler(args)
+
+    def event(index):
+        words = italian_words if random.random() < args.non_english_ratio else english_words
+
+        return {"payload": random_prompt(words, args.input_lengths[0]), "parameters": {"max_length": 50}}
+
+    results = []
+    for concurrency in args.concurrency:
+        requests = [event(index) for index in range(args.iterations)]
+
+        name = "handler/single/concurrency={}".format(concurrency)
+        results.append(run_scenario(name, requests, lambda e: handler.lambda_handler(e, None), concurrency))
+
+    for batch_size in args.batch_sizes:
+        requests = [
+            {"payloads": [event(index)["payload"] for index in range(batch_size)], "parameters": {"max_length": 50}}
+            for _ in range(max(1, args.iterations // batch_size))
+        ]
+
+        name = "handler/batch={}".format(batch_size)
+        results.append(run_scenario(name, requests, lambda e: handler.lambda_handler(e, None),
+                                    items_per_request=batch_size))
+
+    return results
+
+def benchmark_replay(args, model_dir):
+    """
+    Replay a json lines file of recorded events, each with "payload", "parameters" and optionally "source_language".
+    """
+    with open(args.requests_file, "r") as f:
+        events = [json.loads(line) for line in f if len(line.strip()) > 0]
+
+    if args.target == "handler":
+        handler = load_handler(args)
+
+        def call(event):
+            handler.lambda_handler(dict(event), None)
+    else:
+        inference, model_and_tokenizer = load_inference(model_dir, args.backend)
+
+        def call(event):
+            inference.predict_fn({"inputs": event["payload"], "parameters": dict(event.get("parameters") or {})},
+                                 model_and_tokenizer)
+
+    results = []
+    for concurrency in args.concurrency:
+        name = "replay/{}/{}/concurrency={}".format(os.path.basename(args.requests_file), args.target, concurrency)
+        results.append(run_scenario(name, events, call, concurrency))
+
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the latencies and throughput of every scenario with the baseline, returning the regressions. Percentiles
+    that are the slowest request of either run are reported but not checked, since a single outlier moves them.
+    """
+    percentiles = {"p50_ms": 50, "p95_ms": 95, "p99_ms": 99}
+    baseline = {result["name"]: result for result in baseline}
+    regressions = []
+
+    for result in results:
+        previous = baseline.get(result["name"])
+        if previous is None:
+            continue
+
+        result["baseline"] = {}
+        for metric in ["p50_ms", "p95_ms", "p99_ms", "throughput_rps", "peak_memory_mb"]:
+            change = (result[metric] - previous[metric]) / max(previous[metric], 1e-9)
+            result["baseline"][metric] = {"value": previous[metric], "change": round(change, 4)}
+
+            if metric in percentiles and (is_max_rank(percentiles[metric], result["requests"]) or
+                                          is_max_rank(percentiles[metric], previous["requests"])):
+                continue
+
+            worse = -change if metric == "throughput_rps" else change
+            if worse > tolerance:
+                regressions.append("{} {} changed by {:.1%}".format(result["name"], metric, change))
+
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("suite", choices=["inference", "handler", "replay"])
+    parser.add_argument("--log-level", type=str, default=os.environ.get("LOGLEVEL", "INFO").upper())
+    parser.add_argument("--model-dir", type=str, default=None)
+    parser.add_argument("--backend", type=str, choices=["gpu-int8", "cpu-int8", "cpu"], default="cpu")
+    parser.add_argument("--batch-sizes", type=lambda x: [int(v) for v in x.split(",")], default=[1, 4, 8])
+    parser.add_argument("--input-lengths", type=lambda x: [int(v) for v in x.split(",")], default=[16, 128])
+    parser.add_argument("--max-lengths", type=lambda x: [int(v) for v in x.split(",")], default=[32])
+    parser.add_argument("--num-beams", type=lambda x: [int(v) for v in x.split(",")], default=[1, 4])
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--concurrency", type=lambda x: [int(v) for v in x.split(",")], default=[1, 8])
+    parser.add_argument("--comprehend-latency-ms", type=float, default=30)
+    parser.add_argument("--translate-latency-ms", type=float, default=50)
+    parser.add_argument("--endpoint-latency-ms", type=float, default=500)
+    parser.add_argument("--endpoint-item-latency-ms", type=float, default=20)
+    parser.add_argument("--non-english-ratio", type=float, default=0.5)
+    parser.add_argument("--translation-cache", action="store_true")
+    parser.add_argument("--response-cache", action="store_true")
+    parser.add_argument("--requests-file", type=str, default=None)
+    parser.add_argument("--target", type=str, choices=["handler", "inference"], default="handler")
+    parser.add_argument("--output", type=str, default="benchmark-results.json")
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=42)
+
+    args, _ = parser.parse_known_args()
+
+    logging.basicConfig(format="%(levelname)s: [%(filename)s:%(lineno)s] %(message)s", level=args.log_level)
+
+    random.seed(args.seed)
+
+    # repeated prompts would be served by the response cache instead of the model
+    if not args.response_cache:
+        os.environ["RESPONSE_CACHE_SIZE"] = "0"
+
+    with TemporaryDirectory() as tmpdir:
+        model_dir = args.model_dir
+        if model_dir is None and (args.suite == "inference" or args.target == "inference"):
+            model_dir = tmpdir
+            build_tiny_checkpoint(model_dir)
+
+        if args.suite == "inference":
+            results = benchmark_inference(args, model_dir)
+        elif args.suite == "handler":
+            results = benchmark_handler(args)
+        else:
+            results = benchmark_replay(args, model_dir)
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+
+    report = {
+        "suite": args.suite,
+        "arguments": {key: value for key, value in vars(args).items() if key not in ["log_level"]},
+        "results": results,
+        "regressions": regressions
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
+
+    logger.info("Results written to {}".format(args.output))
+
+    for regression in regressions:
+        logger.warning("Regression: {}".format(regression))
+
+    if len(regressions) > 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,10 @@
 import argparse
 import boto3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from distutils.dir_util import copy_tree
+import gzip
+import hashlib
 from huggingface_hub import snapshot_download
 import json
 import logging
@@ -11,13 +15,17 @@ from sagemaker.huggingface.model import HuggingFaceModel
 import tarfile
 from tempfile import TemporaryDirectory
 import time
-from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 model_dir_name = "model"
 s3_artifacts_path = "artifacts/lambda"
 s3_model_path = "models"
 
+# S3 copies at most 5 GB per part, and every part but the last one must be at least 5 MB
+max_copy_part_size = 5 * 1024 * 1024 * 1024
+min_part_size = 5 * 1024 * 1024
+
 logger = logging.getLogger(__name__)
 
 sagemaker_session = sagemaker.Session()
@@ -35,8 +43,435 @@ def compress(tar_dir=None, output_file="model.tar.gz"):
             tar.add(item, arcname=item)
     os.chdir(parent_dir)
 
+class S3MultipartTarget:
+    """
+    Upload the bytes written to it as the parts of a multipart upload, sending several parts at the same time.
+    """
+    def __init__(self, s3_client, bucket, key, part_size=64 * 1024 * 1024, max_workers=8):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.buffer = bytearray()
+        self.bytes_written = 0
+        self.parts = deque()
+        self.completed_parts = []
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+
+    def upload_part(self, part_number, body):
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body)
+
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def upload_part_copy(self, part_number, source_bucket, source_key, start, end):
+        response = self.s3_client.upload_part_copy(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            CopySource={"Bucket": source_bucket, "Key": source_key},
+            CopySourceRange="bytes={}-{}".format(start, end))
+
+        return {"PartNumber": part_number, "ETag": response["CopyPartResult"]["ETag"]}
+
+    def copy_from(self, source_url, size):
+        """
+        Copy the first size bytes of an existing object as the first parts of the upload, without downloading them.
+        """
+        source_bucket, source_key = source_url[len("s3://"):].split("/", 1)
+
+        count = -(-size // max_copy_part_size)
+        for index in range(count):
+            start = size * index // count
+            end = size * (index + 1) // count
+            part_number = len(self.completed_parts) + len(self.parts) + 1
+            self.parts.append(
+                self.executor.submit(self.upload_part_copy, part_number, source_bucket, source_key, start, end - 1))
+
+        self.bytes_written += size
+
+    def submit(self, body):
+        part_number = len(self.completed_parts) + len(self.parts) + 1
+        self.parts.append(self.executor.submit(self.upload_part, part_number, body))
+
+        # bound the parts kept in memory while they are uploaded
+        while len(self.parts) > self.max_workers:
+            self.completed_parts.append(self.parts.popleft().result())
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+
+        while len(self.buffer) >= self.part_size:
+            self.submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+
+    def close(self):
+        try:
+            # the last part can be smaller than the minimum part size
+            if len(self.buffer) > 0 or len(self.completed_parts) + len(self.parts) == 0:
+                self.submit(bytes(self.buffer))
+                self.buffer = bytearray()
+
+            while len(self.parts) > 0:
+                self.completed_parts.append(self.parts.popleft().result())
+
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.completed_parts})
+        finally:
+            self.executor.shutdown()
+
+        return "s3://{}/{}".format(self.bucket, self.key)
 
-def extend_config(args, stage_config, container_def):
+    def abort(self):
+        self.executor.shutdown()
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+class LocalTarget:
+    """
+    Stand-in for S3MultipartTarget writing to a local file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.bytes_written = 0
+        self.file = open(path, "wb")
+
+    def write(self, data):
+        self.file.write(data)
+        self.bytes_written += len(data)
+
+    def copy_from(self, source_path, size):
+        with open(source_path, "rb") as f:
+            remaining = size
+            while remaining > 0:
+                data = f.read(min(remaining, 16 * 1024 * 1024))
+                if len(data) == 0:
+                    raise Exception("{} is shorter than {} bytes".format(source_path, size))
+
+                self.write(data)
+                remaining -= len(data)
+
+    def close(self):
+        self.file.close()
+
+        return self.path
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.path)
+
+class ParallelGzipWriter:
+    """
+    Compress the bytes written to it in blocks on multiple cores, and write the blocks in order to the target. Every
+    block is a complete gzip member, and a sequence of gzip members is a valid gzip file.
+    """
+    def __init__(self, target, block_size=16 * 1024 * 1024, max_workers=None, compresslevel=6, progress_interval=10,
+                 offset=0):
+        self.target = target
+        # uncompressed bytes already in the target
+        self.offset = offset
+        self.block_size = block_size
+        self.max_workers = max_workers or os.cpu_count()
+        self.compresslevel = compresslevel
+        self.progress_interval = progress_interval
+        self.buffer = bytearray()
+        self.blocks = deque()
+        self.bytes_read = 0
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.started = time.time()
+        self.last_progress = self.started
+
+    def submit(self, block):
+        # zlib releases the GIL, so the blocks are compressed in parallel by the threads
+        self.blocks.append(self.executor.submit(gzip.compress, block, self.compresslevel, mtime=0))
+
+        while len(self.blocks) > 2 * self.max_workers:
+            self.target.write(self.blocks.popleft().result())
+
+        if time.time() - self.last_progress >= self.progress_interval:
+            self.last_progress = time.time()
+            self.log_progress()
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_read += len(data)
+
+        while len(self.buffer) >= self.block_size:
+            self.submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+
+        return len(data)
+
+    def log_progress(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+
+        logger.info("Packaged {:.1f} MB, written {:.1f} MB compressed, {:.1f} MB/s".format(
+            self.bytes_read / 1024 / 1024,
+            self.target.bytes_written / 1024 / 1024,
+            self.bytes_read / 1024 / 1024 / elapsed))
+
+    def tell(self):
+        return self.offset + self.bytes_read
+
+    def flush(self):
+        """
+        End the current gzip member and write the pending blocks, returning the compressed size of the target.
+        """
+        if len(self.buffer) > 0:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+
+        while len(self.blocks) > 0:
+            self.target.write(self.blocks.popleft().result())
+
+        return self.target.bytes_written
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+
+        self.log_progress()
+
+def add_sources(tar, sources):
+    for source_dir, arcname in sources:
+        for item in sorted(os.listdir(source_dir)):
+            logger.info("Adding {}".format(os.path.join(arcname, item)))
+            tar.add(os.path.join(source_dir, item), arcname=os.path.join(arcname, item),
+                    filter=lambda tarinfo: None if tarinfo.name.endswith("__pycache__") else tarinfo)
+
+def package_streaming(weights_sources, code_sources, target, block_size=16 * 1024 * 1024, max_workers=None,
+                      weights_archive=None):
+    """
+    Write the model.tar.gz of the (directory, path in the archive) sources to the target, compressing the tar stream
+    on multiple cores while it is written, without an intermediate archive or copy of the files.
+
+    The weights end on a gzip member boundary, so that a later build with the same weights copies them from this
+    archive: weights_archive is the (url, compressed size, tar size) of the weights in a previous archive, in which
+    case only the code is packaged.
+
+    Return the url of the archive and the compressed size and tar size of its weights.
+    """
+    try:
+        if weights_archive is not None:
+            weights_url, weights_size, weights_tar_size = weights_archive
+            target.copy_from(weights_url, weights_size)
+            writer = ParallelGzipWriter(target, block_size, max_workers, offset=weights_tar_size)
+        else:
+            writer = ParallelGzipWriter(target, block_size, max_workers)
+
+        # the snapshot files are symlinks to the downloaded blobs, the archive stores their content
+        tar = tarfile.open(fileobj=writer, mode="w", dereference=True)
+
+        if weights_archive is None:
+            add_sources(tar, weights_sources)
+            weights_size, weights_tar_size = writer.flush(), writer.tell()
+
+        add_sources(tar, code_sources)
+        tar.close()
+        writer.close()
+
+        return target.close(), weights_size, weights_tar_size
+    except BaseException:
+        target.abort()
+        raise
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(data)
+
+    return digest.hexdigest()
+
+def directory_hashes(directory):
+    """
+    Return the content hash of every file in the directory, by relative path.
+    """
+    hashes = {}
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if d != "__pycache__")
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            hashes[os.path.relpath(path, directory)] = file_hash(path)
+
+    return hashes
+
+def snapshot_hashes(model_id):
+    """
+    Return the commit of the current revision of a Hugging Face model and the content hash of every file of this
+    revision from the metadata of the hub, without downloading it: the sha256 of the LFS files and the git blob id of
+    the others.
+    """
+    from huggingface_hub import HfApi
+
+    info = HfApi().model_info(model_id, files_metadata=True)
+
+    hashes = {}
+    for sibling in info.siblings:
+        lfs = sibling.lfs
+        if lfs is None:
+            hashes[sibling.rfilename] = sibling.blob_id
+        else:
+            hashes[sibling.rfilename] = lfs["sha256"] if isinstance(lfs, dict) else lfs.sha256
+
+    return info.sha, hashes
+
+def content_hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+def read_manifest(bucket, key):
+    try:
+        return json.loads(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read())
+    except s3_client.exceptions.NoSuchKey:
+        return None
+
+def build_lambda_zip(output_file):
+    """
+    Write the lambda archive with fixed timestamps and permissions, so that the same code gives the same archive.
+    """
+    with ZipFile(output_file, 'w', compression=ZIP_DEFLATED) as zip_object:
+        zip_info = ZipInfo("lambda/handler.py", date_time=(1980, 1, 1, 0, 0, 0))
+        zip_info.external_attr = 0o644 << 16
+        zip_info.compress_type = ZIP_DEFLATED
+
+        with open(os.path.join(BASE_DIR, "lambda", "handler.py"), "rb") as f:
+            zip_object.writestr(zip_info, f.read())
+
+def convert_to_safetensors(model_dir):
+    """
+    Convert the pytorch checkpoint shards in model_dir to safetensors shards, which are memory-mapped when loaded.
+    """
+    import torch
+    from safetensors.torch import save_file
+
+    index_file = os.path.join(model_dir, "pytorch_model.bin.index.json")
+
+    if os.path.exists(index_file):
+        with open(index_file, "r") as f:
+            index = json.load(f)
+        shards = sorted(set(index["weight_map"].values()))
+    elif os.path.exists(os.path.join(model_dir, "pytorch_model.bin")):
+        index = None
+        shards = ["pytorch_model.bin"]
+    else:
+        logger.info("No pytorch checkpoint to convert in {}".format(model_dir))
+        return
+
+    weight_map = {}
+    for shard in shards:
+        started = time.time()
+        state_dict = torch.load(os.path.join(model_dir, shard), map_location="cpu")
+
+        # tied weights share their storage, which is not allowed in a safetensors file
+        storages = set()
+        for name, tensor in state_dict.items():
+            if tensor.data_ptr() in storages:
+                state_dict[name] = tensor.clone()
+            storages.add(tensor.data_ptr())
+            state_dict[name] = state_dict[name].contiguous()
+
+        safetensors_shard = shard.replace("pytorch_model", "model").replace(".bin", ".safetensors")
+        save_file(state_dict, os.path.join(model_dir, safetensors_shard), metadata={"format": "pt"})
+        os.remove(os.path.join(model_dir, shard))
+
+        for name in state_dict.keys():
+            weight_map[name] = safetensors_shard
+
+        del state_dict
+
+        logger.info("Converted {} to {} in {:.1f} s".format(shard, safetensors_shard, time.time() - started))
+
+    if index is not None:
+        with open(os.path.join(model_dir, "model.safetensors.index.json"), "w") as f:
+            json.dump({"metadata": index.get("metadata", {}), "weight_map": weight_map}, f, indent=2)
+        os.remove(index_file)
+
+def build_model_archive(args, weights_models, code_dir, model_dir, model_prefix, weights_archive=None, revisions=None):
+    """
+    Package and upload model.tar.gz, with the weights of the given revisions by path in the archive, or of the current
+    revisions. Return its url, and the compressed size and tar size of its weights when they end on a gzip member
+    boundary.
+    """
+    if revisions is None:
+        revisions = {}
+
+    def streaming_target():
+        if args.package_local_path is not None:
+            return LocalTarget(args.package_local_path)
+
+        return S3MultipartTarget(
+            s3_client,
+            args.default_bucket,
+            model_prefix + "/model.tar.gz",
+            args.upload_part_size_mb * 1024 * 1024,
+            args.upload_workers)
+
+    code_sources = [(code_dir, "code")]
+
+    if weights_archive is not None:
+        logger.info("Weights unchanged, copying them from {}".format(weights_archive[0]))
+
+        return package_streaming([], code_sources, streaming_target(), args.package_block_size_mb * 1024 * 1024,
+                                 args.package_workers, weights_archive)
+
+    with TemporaryDirectory() as tmpdir:
+        weights_sources = []
+        for model_id, arcname in weights_models:
+            # download snapshot
+            snapshot_dir = snapshot_download(repo_id=model_id, revision=revisions.get(arcname), cache_dir=tmpdir)
+
+            if args.safetensors:
+                convert_to_safetensors(snapshot_dir)
+
+            weights_sources.append((snapshot_dir, arcname))
+
+        if args.streaming_package:
+            return package_streaming(weights_sources, code_sources, streaming_target(),
+                                     args.package_block_size_mb * 1024 * 1024, args.package_workers)
+
+        # copy snapshot to model dir
+        for source_dir, arcname in weights_sources + code_sources:
+            copy_tree(source_dir, str(model_dir.joinpath(arcname)))
+
+    compress(str(model_dir))
+
+    model_url = sagemaker.Session().upload_data(
+        os.path.join(BASE_DIR, "model.tar.gz"),
+        bucket=args.default_bucket,
+        key_prefix=model_prefix
+    )
+
+    return model_url, None, None
+
+def parse_cascade_models(cascade_model_ids):
+    """
+    Parse the "name=model_id,..." list of the smaller models of the cascade, from the cheapest to the largest.
+    """
+    cascade_models = []
+    for entry in cascade_model_ids.split(","):
+        if len(entry.strip()) == 0:
+            continue
+        if "=" not in entry:
+            raise Exception("Cascade models must be given as name=model_id, got {}".format(entry))
+
+        name, model_id = entry.split("=", 1)
+        cascade_models.append((name.strip(), model_id.strip()))
+
+    return cascade_models
+
+def extend_config(args, stage_config, container_def, lambda_path=s3_artifacts_path + "/lambda.zip", model_name=None):
     """
     Extend the stage configuration with additional parameters and tags based.
     """
@@ -45,16 +480,21 @@ def extend_config(args, stage_config, container_def):
         raise Exception("Configuration file must include SageName parameter")
     if not "Tags" in stage_config:
         stage_config["Tags"] = {}
+    # The lambda routes the requests from the cheapest model of the cascade to the main model
+    cascade_models = parse_cascade_models(args.cascade_model_ids)
+    cascade_tiers = [name for name, _ in cascade_models] + [args.model_tier] if len(cascade_models) > 0 else []
     # Create new params and tags
     new_params = {
         "ContainerImage": container_def["Image"],
         "EndpointInstanceCount": str(args.inference_instance_count),
         "EndpointInstanceType": args.inference_instance_type,
         "EndpointName": args.endpoint_name,
+        "CascadeTiers": ",".join(cascade_tiers),
         "LambdaName": args.lambda_name,
-        "LambdaPath": s3_artifacts_path + "/lambda.zip",
+        "LambdaPath": lambda_path,
         "ModelDataUrl": container_def["ModelDataUrl"],
-        "ModelName": args.model_name + "-" + str(round(time.time())),
+        "ModelName": model_name or args.model_name + "-" + str(round(time.time())),
+        "ModelTier": args.model_tier,
         "ModelExecutionRoleArn": args.model_execution_role,
         "S3BucketArtifacts": args.default_bucket,
         "SageMakerProjectName": args.sagemaker_project_name,
@@ -133,6 +573,16 @@ def main():
     parser.add_argument("--export-staging-params", type=str, default="staging-params-export.json")
     parser.add_argument("--export-staging-tags", type=str, default="staging-tags-export.json")
     parser.add_argument("--export-cfn-params-tags", type=bool, default=False)
+    parser.add_argument("--safetensors", action="store_true")
+    parser.add_argument("--cascade-model-ids", type=str, default="")
+    parser.add_argument("--model-tier", type=str, default="xxl")
+    parser.add_argument("--streaming-package", action="store_true")
+    parser.add_argument("--package-block-size-mb", type=int, default=16)
+    parser.add_argument("--package-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--upload-part-size-mb", type=int, default=64)
+    parser.add_argument("--upload-workers", type=int, default=8)
+    parser.add_argument("--package-local-path", type=str, default=None)
+    parser.add_argument("--incremental", action="store_true")
 
     args, _ = parser.parse_known_args()
 
@@ -145,21 +595,55 @@ def main():
     if not os.path.isdir(os.path.join(BASE_DIR, model_dir_name)):
         model_dir.mkdir()
 
-    with TemporaryDirectory() as tmpdir:
-        # download snapshot
-        snapshot_dir = snapshot_download(repo_id=args.hf_model_id, cache_dir=tmpdir)
-        # copy snapshot to model dir
-        copy_tree(snapshot_dir, str(model_dir))
+    # models packaged in model.tar.gz, as (model id, path in the archive), and inference code
+    weights_models = [(args.hf_model_id, "")] + [
+        (model_id, os.path.join("tiers", name)) for name, model_id in parse_cascade_models(args.cascade_model_ids)
+    ]
+    code_dir = os.path.join(BASE_DIR, "code")
 
-    copy_tree(os.path.join(BASE_DIR, "code") + "/", str(model_dir.joinpath("code")))
+    model_prefix = "/".join([s3_model_path, args.model_name])
+    manifest_key = model_prefix + "/manifest.json"
+    manifest = {}
+    previous = None
+    revisions = None
 
-    compress(str(model_dir))
+    if args.incremental:
+        previous = read_manifest(args.default_bucket, manifest_key)
 
-    model_url = sagemaker.Session().upload_data(
-        os.path.join(BASE_DIR, "model.tar.gz"),
-        bucket=args.default_bucket,
-        key_prefix="/".join([s3_model_path, args.model_name])
-    )
+        manifest["weights"] = {}
+        for model_id, arcname in weights_models:
+            revision, files = snapshot_hashes(model_id)
+            manifest["weights"][arcname] = {"model_id": model_id, "revision": revision, "files": files}
+
+        # the weights are downloaded at the hashed revisions, even when the model is updated on the hub meanwhile
+        revisions = {arcname: weights["revision"] for arcname, weights in manifest["weights"].items()}
+
+        weights_hash = {arcname: {"model_id": weights["model_id"], "files": weights["files"]}
+                        for arcname, weights in manifest["weights"].items()}
+        manifest["weights_hash"] = content_hash({"weights": weights_hash, "safetensors": args.safetensors})
+        manifest["code"] = directory_hashes(code_dir)
+        manifest["code_hash"] = content_hash(manifest["code"])
+
+        # archives with different contents never overwrite each other, so that deployed models keep their data
+        model_prefix = "/".join([model_prefix, content_hash([manifest["weights_hash"], manifest["code_hash"]])[:16]])
+
+    same_weights = previous is not None and previous["weights_hash"] == manifest.get("weights_hash")
+
+    if same_weights and previous["code_hash"] == manifest["code_hash"]:
+        logger.info("Weights and code unchanged, reusing {}".format(previous["model_data_url"]))
+
+        model_url = previous["model_data_url"]
+        weights_size = previous.get("weights_size")
+        weights_tar_size = previous.get("weights_tar_size")
+    else:
+        weights_archive = None
+
+        # only streamed archives end their weights on a gzip member boundary, and S3 copies parts of at least 5 MB
+        if same_weights and args.streaming_package and (previous.get("weights_size") or 0) >= min_part_size:
+            weights_archive = (previous["model_data_url"], previous["weights_size"], previous["weights_tar_size"])
+
+        model_url, weights_size, weights_tar_size = build_model_archive(
+            args, weights_models, code_dir, model_dir, model_prefix, weights_archive, revisions)
 
     logger.info("S3 model url: {}".format(model_url))
 
@@ -175,21 +659,40 @@ def main():
 
     container_def = model.prepare_container_def(instance_type=args.inference_instance_type)
 
-    with ZipFile(os.path.join(BASE_DIR, "lambda.zip"), 'w') as zip_object:
-        # Adding files that need to be zipped
-        zip_object.write(os.path.join(BASE_DIR, "lambda", "handler.py"), "lambda/handler.py")
+    lambda_zip = os.path.join(BASE_DIR, "lambda.zip")
+    build_lambda_zip(lambda_zip)
 
-    lambda_url = sagemaker.Session().upload_data(
-        os.path.join(BASE_DIR, "lambda.zip"),
-        bucket=args.default_bucket,
-        key_prefix=s3_artifacts_path
-    )
+    lambda_path = s3_artifacts_path + "/lambda.zip"
+    model_name = None
+
+    if args.incremental:
+        manifest["lambda_hash"] = file_hash(lambda_zip)
+
+        # CloudFormation updates the function and the model only when their path or name change
+        lambda_path = "/".join([s3_artifacts_path, manifest["lambda_hash"][:16], "lambda.zip"])
+        model_name = args.model_name + "-" + content_hash([container_def["Image"], model_url, args.model_tier])[:12]
+
+    if previous is not None and previous.get("lambda_hash") == manifest["lambda_hash"]:
+        logger.info("Lambda unchanged, reusing {}".format(lambda_path))
+    else:
+        lambda_url = sagemaker.Session().upload_data(
+            lambda_zip,
+            bucket=args.default_bucket,
+            key_prefix=os.path.dirname(lambda_path)
+        )
+
+        logger.info("S3 lambda url: {}".format(lambda_url))
+
+    if args.incremental:
+        manifest["model_data_url"] = model_url
+        manifest["weights_size"] = weights_size
+        manifest["weights_tar_size"] = weights_tar_size
 
-    logger.info("S3 lambda url: {}".format(lambda_url))
+        s3_client.put_object(Bucket=args.default_bucket, Key=manifest_key, Body=json.dumps(manifest, indent=4))
 
     # Write the staging config
     with open(args.import_staging_config, "r") as f:
-        staging_config = extend_config(args, json.load(f), container_def)
+        staging_config = extend_config(args, json.load(f), container_def, lambda_path, model_name)
     logger.debug("Staging config: {}".format(json.dumps(staging_config, indent=4)))
     with open(args.export_staging_config, "w") as f:
         json.dump(staging_config, f, indent=4)
@@ -1,6 +1,9 @@
 import boto3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import itertools
 import json
 import streamlit as st
+import time
 
 # Create a low-level client representing Amazon SageMaker Runtime
 session = boto3.Session()
@@ -17,16 +20,50 @@ min_length, max_length = st.sidebar.slider("Min/Max length", 0, 500, (0, 100))
 temperature = st.sidebar.slider("Temperature", min_value=0.0, max_value=1.0, value=0.3)
 rep_penalty = st.sidebar.slider("Repetition Penalty", min_value=0.9, max_value=1.2, value=1.0)
 
-def generate_text(prompt):
+# comparison of the outputs for every combination of the comma separated values
+compare = st.sidebar.checkbox("Compare", value=False)
+if compare:
+    temperatures = st.sidebar.text_input("Temperatures", value=str(temperature))
+    length_penalties = st.sidebar.text_input("Length Penalties", value=str(length_penalty))
+    rep_penalties = st.sidebar.text_input("Repetition Penalties", value=str(rep_penalty))
+    max_lengths = st.sidebar.text_input("Max lengths", value=str(max_length))
+    max_workers = st.sidebar.slider("Concurrent calls", min_value=1, max_value=16, value=4)
+
+# outputs of the previous runs of this session, by prompt and parameters
+results_cache = st.session_state.setdefault("results", {})
+
+def get_parameters(**overrides):
     parameters = {
         "early_stopping": True,
         "length_penalty": length_penalty,
         "min_length": min_length,
         "max_length": max_length,
         "temperature": temperature,
-        "repetition_penalty": rep_penalty
+        "repetition_penalty": rep_penalty,
+        **overrides
     }
 
+    # the generation stops on the endpoint as soon as the stop word is generated
+    if len(stop_word) > 0:
+        parameters["stop_sequences"] = [stop_word]
+
+    return parameters
+
+def cache_key(prompt, parameters):
+    return json.dumps([prompt, parameters], sort_keys=True)
+
+def parse_values(values, cast):
+    return [cast(value) for value in values.split(",") if len(value.strip()) > 0]
+
+def describe(parameters):
+    return "temperature {}{}, length penalty {}, repetition penalty {}, max length {}".format(
+        parameters["temperature"], " (sampling)" if parameters.get("do_sample", False) else "",
+        parameters["length_penalty"], parameters["repetition_penalty"], parameters["max_length"])
+
+def generate_text(prompt, parameters=None):
+    if parameters is None:
+        parameters = get_parameters()
+
     print("Payload: {}".format(prompt))
     print("Parameters: {}".format(parameters))
 
@@ -42,17 +79,91 @@ def generate_text(prompt):
 
     results = json.loads(response['Payload'].read().decode("utf-8"))
 
-    if results["statusCode"] == 200:
-        if len(json.loads(results["body"])) > 0 and "generated_text" in json.loads(results["body"])[0]:
-            return json.loads(results["body"])[0]["generated_text"]
+    # failed invocations return the error of the function, without statusCode
+    if results.get("statusCode") == 200:
+        predictions = json.loads(results["body"])
+
+        if len(predictions) > 0 and "generated_text" in predictions[0]:
+            return predictions[0]["generated_text"]
 
     return results
 
+def timed_generate_text(prompt, parameters):
+    started = time.time()
+    generated_text = generate_text(prompt, parameters)
+
+    return generated_text, time.time() - started
+
 st.header("Flan-T5-XXL Playground")
 prompt = st.text_area("Enter your prompt here:")
 
+def render_result(placeholder, parameters, generated_text, latency):
+    placeholder.markdown("**{}**\n\n{}\n\n_{}_".format(
+        describe(parameters), generated_text, "cached" if latency is None else "{:.2f} s".format(latency)))
+
+def run_comparison(prompt):
+    # the temperature only changes the output when sampling, a temperature of 0 is greedy decoding
+    grid = [
+        get_parameters(temperature=t, do_sample=t > 0, length_penalty=lp, repetition_penalty=rp, max_length=ml)
+        for t, lp, rp, ml in itertools.product(
+            parse_values(temperatures, float),
+            parse_values(length_penalties, float),
+            parse_values(rep_penalties, float),
+            parse_values(max_lengths, int))
+    ]
+
+    if len(grid) == 0:
+        st.warning("Enter at least one value for every parameter")
+        return
+
+    # one placeholder per combination, filled as soon as its invocation finishes
+    columns_count = min(len(grid), 3)
+    placeholders = []
+    for start in range(0, len(grid), columns_count):
+        for column, parameters in zip(st.columns(columns_count), grid[start:start + columns_count]):
+            placeholders.append(column.empty())
+            placeholders[-1].markdown("**{}**\n\nRunning...".format(describe(parameters)))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for placeholder, parameters in zip(placeholders, grid):
+            key = cache_key(prompt, parameters)
+
+            if key in results_cache:
+                render_result(placeholder, parameters, results_cache[key], None)
+            else:
+                futures[executor.submit(timed_generate_text, prompt, parameters)] = (placeholder, parameters, key)
+
+        for future in as_completed(futures):
+            placeholder, parameters, key = futures[future]
+
+            # a failed invocation is shown in its own cell, the other cells keep rendering
+            try:
+                generated_text, latency = future.result()
+            except Exception as e:
+                placeholder.error("**{}**\n\n{}".format(describe(parameters), e))
+                continue
+
+            # sampled outputs and errors are not cached, so that they are generated again by the next run
+            if isinstance(generated_text, str) and not parameters["do_sample"]:
+                results_cache[key] = generated_text
+
+            render_result(placeholder, parameters, generated_text, latency)
+
 if st.button("Run"):
-    generated_text = generate_text(prompt)
-    if len(stop_word) > 0:
-        generated_text = generated_text[:generated_text.rfind(stop_word)]
-    st.write(generated_text)
\ No newline at end of file
+    if compare:
+        run_comparison(prompt)
+    else:
+        placeholder = st.empty()
+        key = cache_key(prompt, get_parameters())
+
+        if key in results_cache:
+            generated_text = results_cache[key]
+        else:
+            generated_text = generate_text(prompt)
+
+            # errors are not cached, so that they are retried by the next run
+            if isinstance(generated_text, str):
+                results_cache[key] = generated_text
+
+        placeholder.write(generated_text)
\ No newline at end of file